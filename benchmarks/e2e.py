@@ -0,0 +1,288 @@
+"""
+End-to-end benchmark of the conversation flows.
+
+Drives the real application (handlers, conversation states, per-user
+ordering, rate limits, outbox) with a fake bot which never touches
+telegram. Mongo is either a real server given by --mongo-url (a separate
+database is used, it's dropped on start) or mongomock, if installed.
+mongomock scans collections on every query, so use it for db calls per
+update and relative numbers only.
+
+A synthetic population is created first, then simulated users go through
+the flow step by step: all users make a step concurrently, then the next
+one. Results are printed as JSON:
+
+    python -m benchmarks.e2e --population 10000 --users 500 --output before.json
+"""
+
+import os
+
+# must be set before wtb is imported
+os.environ.setdefault("TELEGRAM_API_TOKEN", "1:benchmark")
+os.environ.setdefault("WTB_MONGO_DB", "wtb_benchmark")
+os.environ.setdefault("WTB_METRICS_PORT", "0")
+# telegram flood limits don't apply to the fake bot
+os.environ.setdefault("WTB_OUTBOX_GLOBAL_RATE", "1000000")
+os.environ.setdefault("WTB_OUTBOX_CHAT_INTERVAL", "0")
+
+import sys  # noqa: E402
+import json  # noqa: E402
+import math  # noqa: E402
+import time  # noqa: E402
+import random  # noqa: E402
+import asyncio  # noqa: E402
+import argparse  # noqa: E402
+import datetime  # noqa: E402
+import itertools  # noqa: E402
+import subprocess  # noqa: E402
+
+import pymongo  # noqa: E402
+import pymongo.monitoring  # noqa: E402
+import telegram  # noqa: E402
+import telegram.ext  # noqa: E402
+
+from wtb import db  # noqa: E402
+from wtb import botutils  # noqa: E402
+from wtb import frontend  # noqa: E402
+from wtb import matchpool  # noqa: E402
+from wtb import migrations  # noqa: E402
+from wtb import usagestats  # noqa: E402
+
+
+LANGUAGES = ["English", "Russian", "German", "French", "Spanish", "Italian", "Portuguese", "Japanese"]
+
+# simulated users get ids above the population ones
+SIMULATED_USER_ID_BASE = 10 ** 9
+
+# replaced with simulated user's languages
+NATIVE_LANGUAGE = object()
+SEARCH_LANGUAGE = object()
+
+# (step, text) sent by every simulated user, results are reported per step
+FLOW = [
+    ("start", "/start"),
+    ("set_native_language_prompt", frontend.TextCommands.SET_NATIVE_LANGUAGE),
+    ("set_native_language", NATIVE_LANGUAGE),
+    ("search_language_prompt", frontend.TextCommands.SEARCH_LANGUAGE),
+    ("search_language", SEARCH_LANGUAGE),
+    ("find_pair", frontend.TextCommands.FIND),
+    ("stats", frontend.STATS),
+]
+
+
+class FakeBot(telegram.ext.ExtBot):
+    """
+    Bot which pretends that all requests succeed
+    """
+
+    async def get_me(self, *args, **kwargs) -> telegram.User:
+        self._bot_user = telegram.User(1, "Benchmark", is_bot=True, username="wtb_benchmark_bot")
+        return self._bot_user
+
+    async def send_message(self, chat_id: int | str, text: str, *args, **kwargs) -> telegram.Message:
+        return telegram.Message(
+            message_id=next(_MESSAGE_IDS),
+            date=datetime.datetime.now(datetime.timezone.utc),
+            chat=telegram.Chat(chat_id, telegram.Chat.PRIVATE),
+            text=text,
+        )
+
+
+_MESSAGE_IDS = itertools.count(1)
+
+
+class CommandCounter(pymongo.monitoring.CommandListener):
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event: pymongo.monitoring.CommandStartedEvent) -> None:
+        self.count += 1
+
+    def succeeded(self, event: pymongo.monitoring.CommandSucceededEvent) -> None:
+        pass
+
+    def failed(self, event: pymongo.monitoring.CommandFailedEvent) -> None:
+        pass
+
+
+def connect(mongo_url: str | None) -> CommandCounter | None:
+    """
+    Set up mongo client, return command counter if real mongo is used
+    """
+    if mongo_url is None:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("Either install mongomock or pass --mongo-url")
+
+        db._MONGO_CLIENT = mongomock.MongoClient()
+        # mongomock doesn't support RawBSONDocument
+        db._get_raw_users_collection = db.get_users_collection
+        return None
+
+    counter = CommandCounter()
+    db._MONGO_CLIENT = pymongo.MongoClient(mongo_url, event_listeners=[counter])
+    db._MONGO_CLIENT.drop_database(db.MONGO_DB_NAME)
+    return counter
+
+
+def populate(size: int, rnd: random.Random) -> None:
+    now = datetime.datetime.utcnow()
+    users = []
+
+    for user_id in range(1, size + 1):
+        language, search_language = rnd.sample(LANGUAGES, 2)
+        users.append({
+            "user_id": user_id,
+            "first_name": f"User {user_id}",
+            "language": language,
+            "search_language": search_language,
+            "pause": rnd.random() < 0.2,
+            "created_at": now - datetime.timedelta(days=rnd.randrange(365)),
+            "last_updated": now,
+            "sent_requests": [],
+        })
+
+    for start in range(0, len(users), 10000):
+        db.get_users_collection().insert_many(users[start:start + 10000])
+
+
+def make_update_data(update_id: int, user_id: int, text: str) -> dict:
+    """
+    Return update as it's sent by telegram
+    """
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"Simulated {user_id}"},
+            "text": text,
+        },
+    }
+
+
+def make_update(bot: telegram.Bot, update_id: int, user_id: int, text: str) -> telegram.Update:
+    return telegram.Update.de_json(make_update_data(update_id, user_id, text), bot)
+
+
+def percentile(values: list[float], percent: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, math.ceil(len(values) * percent / 100) - 1)]
+
+
+async def run(args: argparse.Namespace, counter: CommandCounter | None) -> dict:
+    rnd = random.Random(args.seed)
+    bot = FakeBot(os.environ["TELEGRAM_API_TOKEN"])
+
+    app = botutils.get_application(bot)
+    frontend.add_handlers(app)
+
+    update_ids = itertools.count(1)
+    users = [
+        (SIMULATED_USER_ID_BASE + i, *rnd.sample(LANGUAGES, 2))
+        for i in range(args.users)
+    ]
+
+    latencies: dict[str, list[float]] = {}
+    wall_times: dict[str, float] = {}
+    db_calls = 0
+    commands = 0
+
+    async def process(update: telegram.Update) -> float:
+        start = time.perf_counter()
+        await app.process_update(update)
+        return time.perf_counter() - start
+
+    async with app:
+        await app.post_init(app)
+        try:
+            for step, text in FLOW:
+                updates = []
+                for user_id, language, search_language in users:
+                    if text is NATIVE_LANGUAGE:
+                        update_text = language
+                    elif text is SEARCH_LANGUAGE:
+                        update_text = search_language
+                    else:
+                        update_text = text
+                    updates.append(make_update(bot, next(update_ids), user_id, update_text))
+
+                db_calls_before = db.DB_LATENCY.get_count()
+                commands_before = counter.count if counter else 0
+                start = time.perf_counter()
+
+                step_latencies = await asyncio.gather(*map(process, updates))
+
+                wall_times[step] = time.perf_counter() - start
+                latencies[step] = step_latencies
+                db_calls += db.DB_LATENCY.get_count() - db_calls_before
+                commands += (counter.count if counter else 0) - commands_before
+        finally:
+            await app.post_shutdown(app)
+
+    total_updates = sum(map(len, latencies.values()))
+    total_time = sum(wall_times.values())
+
+    return {
+        "steps": {
+            step: {
+                "updates": len(values),
+                "p50_ms": round(percentile(values, 50) * 1000, 3),
+                "p99_ms": round(percentile(values, 99) * 1000, 3),
+                "updates_per_sec": round(len(values) / wall_times[step], 1),
+            }
+            for step, values in latencies.items()
+        },
+        "updates": total_updates,
+        "updates_per_sec": round(total_updates / total_time, 1),
+        "db_calls_per_update": round(db_calls / total_updates, 2),
+        # commands sent to mongo, including background writes, real mongo only
+        "mongo_commands_per_update": round(commands / total_updates, 2) if counter else None,
+    }
+
+
+def get_commit() -> str | None:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--population", type=int, default=10000, help="number of existing users")
+    parser.add_argument("--users", type=int, default=200, help="number of simulated users going through the flow")
+    parser.add_argument("--mongo-url", help="real mongo to use instead of mongomock")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results to this file instead of stdout")
+    args = parser.parse_args()
+
+    counter = connect(args.mongo_url)
+    rnd = random.Random(args.seed)
+
+    migrations.migrate()
+    populate(args.population, rnd)
+    usagestats.USAGE_STATS.reconcile()
+    matchpool.MATCH_POOL.warm()
+
+    results = {
+        "commit": get_commit(),
+        "population": args.population,
+        "users": args.users,
+        "mongo": "mongodb" if args.mongo_url else "mongomock",
+        "concurrent_updates": botutils.CONCURRENT_UPDATES,
+        **asyncio.run(run(args, counter)),
+    }
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as out:
+            out.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Query time before and after indices.
+
+For every population size a synthetic population is created in a real
+mongo (database `wtb_benchmark` is dropped first), bot queries are timed
+without indices except _id and then with indices from migrations.INDEXES.
+Median duration of --repeat runs is reported per query. mongomock
+ignores indices, so a real server is required:
+
+    python -m benchmarks.indexes --mongo-url mongodb://localhost --sizes 10000 100000 1000000
+"""
+
+import os
+
+# must be set before wtb is imported
+os.environ.setdefault("TELEGRAM_API_TOKEN", "1:benchmark")
+os.environ.setdefault("WTB_MONGO_DB", "wtb_benchmark")
+
+import json  # noqa: E402
+import time  # noqa: E402
+import random  # noqa: E402
+import argparse  # noqa: E402
+import datetime  # noqa: E402
+import statistics  # noqa: E402
+import typing as T  # noqa: E402
+
+from wtb import db  # noqa: E402
+from wtb import migrations  # noqa: E402
+
+from .e2e import LANGUAGES, connect, populate, get_commit  # noqa: E402
+
+
+def get_queries(size: int, rnd: random.Random) -> dict[str, T.Callable[[], T.Any]]:
+    """
+    Return query name -> function which runs it with random arguments
+    """
+    def get_user() -> None:
+        db.USER_CACHE.clear()
+        db.get_user(rnd.randint(1, size))
+
+    def skip_users() -> list[int]:
+        return [rnd.randint(1, size) for _ in range(10)]
+
+    return {
+        "get_user": get_user,
+        "count_language": lambda: db.count_language(rnd.choice(LANGUAGES)),
+        "get_pair": lambda: db.get_pair(skip_users(), rnd.choice(LANGUAGES)),
+        "get_reciprocal_pair": lambda: db.get_reciprocal_pair(skip_users(), *rnd.sample(LANGUAGES, 2)),
+        "get_daily_user_counts": lambda: db.get_daily_user_counts(
+            datetime.datetime.utcnow() - datetime.timedelta(days=30),
+        ),
+        "get_notify_recipients": lambda: db.get_notify_recipients(rnd.choice(LANGUAGES), 0, 100),
+        "get_active_user_ids": lambda: db.get_active_user_ids(rnd.randint(1, size), 100),
+        "get_inactive_users": lambda: db.get_inactive_users(30, 100),
+    }
+
+
+def time_queries(queries: dict[str, T.Callable[[], T.Any]], repeat: int) -> dict[str, float]:
+    results = {}
+
+    for name, query in queries.items():
+        durations = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            query()
+            durations.append(time.perf_counter() - start)
+
+        results[name] = round(statistics.median(durations) * 1000, 3)
+
+    return results
+
+
+def run_size(size: int, args: argparse.Namespace) -> dict:
+    rnd = random.Random(args.seed)
+    mongo_db = db.get_mongo_db()
+    mongo_db.client.drop_database(mongo_db.name)
+
+    populate(size, rnd)
+    # fields which populate doesn't set, but queries use
+    mongo_db.users.update_many({}, [{"$set": {
+        "notify": {"$eq": [{"$mod": ["$user_id", 3]}, 0]},
+        "last_seen": "$last_updated",
+    }}])
+
+    queries = get_queries(size, rnd)
+
+    mongo_db.users.drop_indexes()
+    before = time_queries(queries, args.repeat)
+
+    migrations.ensure_indexes()
+    after = time_queries(queries, args.repeat)
+
+    return {
+        name: {"before_ms": before[name], "after_ms": after[name]}
+        for name in queries
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo-url", required=True, help="mongo to benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000], help="population sizes")
+    parser.add_argument("--repeat", type=int, default=20, help="runs of every query")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results to this file instead of stdout")
+    args = parser.parse_args()
+
+    connect(args.mongo_url)
+
+    results = {
+        "commit": get_commit(),
+        "repeat": args.repeat,
+        "sizes": {str(size): run_size(size, args) for size in args.sizes},
+    }
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as out:
+            out.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Microbenchmark of langsdb.guess_lang over the full language-codes.csv.
+
+Inputs are generated from every language of the CSV: codes, exact names,
+prefixes, inner substrings, names with a typo, unknown words and unseen
+words (random words of 4 to 12 letters, the common miss). Every kind is
+timed with the index (guess_lang) and with the linear scan which was used
+before it (linear_guess_lang), index lookups are uncached, typo lookups
+are cached as well. Results are microseconds per call:
+
+    python -m benchmarks.langs --repeat 5
+"""
+
+import json
+import time
+import random
+import string
+import logging
+import argparse
+import statistics
+import typing as T
+
+from wtb import langsdb
+
+from .e2e import get_commit
+
+
+logger = logging.getLogger(__name__)
+
+
+def linear_guess_lang(maybe_lang, full=False):
+    """
+    guess_lang as it was before the index, for comparison
+    """
+    if len(maybe_lang) < 2:
+        return None
+
+    maybe_lang = maybe_lang.lower()
+
+    short_langs = langsdb.get_long_langs()
+
+    if maybe_lang in short_langs:
+        return short_langs[maybe_lang] if full else maybe_lang
+
+    for key, value in short_langs.items():
+        logger.debug("comparing %s vs %s", maybe_lang, value)
+        if maybe_lang in value.lower():
+            logger.debug("%s looks like %s", maybe_lang, value)
+            return value if full else key
+
+    return None
+
+
+def make_typo(name: str, rnd: random.Random) -> str:
+    i = rnd.randrange(len(name) - 1)
+    # swap two neighbour letters
+    return name[:i] + name[i + 1] + name[i] + name[i + 2:]
+
+
+def get_inputs(rnd: random.Random) -> dict[str, list[str]]:
+    inputs: dict[str, list[str]] = {
+        "code": [],
+        "name": [],
+        "prefix": [],
+        "substring": [],
+        "typo": [],
+        "unknown": [],
+        "unseen": [],
+    }
+
+    for short_3, short_2, longs in langsdb._read_langs():
+        name = longs[0]
+        inputs["code"].append(short_2 or short_3)
+        inputs["name"].append(name)
+        inputs["prefix"].append(name[:max(2, len(name) // 2)])
+        if len(name) > 4:
+            inputs["substring"].append(name[1:-1])
+        if len(name) > 6:
+            inputs["typo"].append(make_typo(name, rnd))
+        inputs["unknown"].append("".join(rnd.choices("qxzjvw", k=8)))
+        inputs["unseen"].append("".join(rnd.choices(string.ascii_lowercase, k=rnd.randint(4, 12))))
+
+    return inputs
+
+
+def time_calls(func: T.Callable[[str], T.Any], inputs: list[str], repeat: int, setup=None) -> float:
+    """
+    Return median time of a call in microseconds
+    """
+    durations = []
+
+    for _ in range(repeat):
+        for maybe_lang in inputs:
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            func(maybe_lang)
+            durations.append(time.perf_counter() - start)
+
+    return round(statistics.median(durations) * 1e6, 3)
+
+
+def run(args: argparse.Namespace) -> dict:
+    inputs = get_inputs(random.Random(args.seed))
+    clear_cache = langsdb._guess_misspelled_lang.cache_clear
+    results = {}
+
+    for kind, values in inputs.items():
+        results[kind] = {
+            "inputs": len(values),
+            "index_us": time_calls(langsdb.guess_lang, values, args.repeat, setup=clear_cache),
+            "linear_us": time_calls(linear_guess_lang, values, args.repeat),
+        }
+
+    # typo lookups are cached, users tend to make the same ones
+    for maybe_lang in inputs["typo"]:
+        langsdb.guess_lang(maybe_lang)
+    results["typo"]["index_cached_us"] = time_calls(langsdb.guess_lang, inputs["typo"], args.repeat)
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="runs over all inputs")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    results = {
+        "commit": get_commit(),
+        "languages": len(langsdb.get_index()["langs"]),
+        **run(args),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
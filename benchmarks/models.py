@@ -0,0 +1,158 @@
+"""
+Memory and allocations of user models.
+
+--users users with --sent-requests sent requests each are encoded to
+BSON and decoded the way pymongo does it, then turned into:
+
+- dataclass: the dataclass User model which was used before the slotted
+  one, from decoded documents;
+- slotted: models.User from raw BSON documents (db.get_user), sent
+  requests aren't decoded;
+- slotted_decoded: the same after sent_requests of every user were
+  accessed;
+- slotted_projection: models.User from documents projected to
+  frontend.KEYBOARD_FIELDS.
+
+Memory retained by the users and peak memory are measured with
+tracemalloc:
+
+    python -m benchmarks.models --users 100000
+"""
+
+import os
+
+# must be set before wtb is imported
+os.environ.setdefault("TELEGRAM_API_TOKEN", "1:benchmark")
+
+import json  # noqa: E402
+import time  # noqa: E402
+import random  # noqa: E402
+import argparse  # noqa: E402
+import datetime  # noqa: E402
+import dataclasses  # noqa: E402
+import tracemalloc  # noqa: E402
+import typing as T  # noqa: E402
+
+import bson  # noqa: E402
+import bson.codec_options  # noqa: E402
+import bson.raw_bson  # noqa: E402
+
+from wtb import models  # noqa: E402
+from wtb import frontend  # noqa: E402
+
+from .e2e import LANGUAGES, get_commit  # noqa: E402
+
+
+RAW_CODEC_OPTIONS = bson.codec_options.CodecOptions(document_class=bson.raw_bson.RawBSONDocument)
+
+
+@dataclasses.dataclass
+class DataclassUser:
+    """
+    models.User before it became slotted, for comparison
+    """
+
+    _id: str
+    user_id: int
+    last_updated: datetime.datetime
+    created_at: datetime.datetime
+    language: str
+    search_language: str = dataclasses.field(default='')
+    sent_requests: list[dict] = dataclasses.field(default_factory=lambda: [])
+
+    first_name: str | None = None
+    last_name: str | None = None
+    username: str | None = None
+    language_code: str | None = None
+
+    pause: bool = dataclasses.field(default=False)
+
+
+def make_doc(user_id: int, sent_requests: int, rnd: random.Random) -> dict:
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    language, search_language = rnd.sample(LANGUAGES, 2)
+
+    return {
+        "_id": bson.ObjectId(),
+        "user_id": user_id,
+        "last_updated": now,
+        "created_at": now,
+        "language": language,
+        "search_language": search_language,
+        "sent_requests": [
+            {"user_id": rnd.randrange(10 ** 9), "language": search_language, "created_at": now}
+            for _ in range(sent_requests)
+        ],
+        "first_name": f"User {user_id}",
+        "last_name": None,
+        "username": f"user{user_id}",
+        "language_code": "en",
+        "pause": False,
+    }
+
+
+def load_dataclass(raw: bytes) -> T.Any:
+    return DataclassUser(**bson.decode(raw))
+
+
+def load_slotted(raw: bytes) -> T.Any:
+    return models.User(**bson.decode(raw, codec_options=RAW_CODEC_OPTIONS))
+
+
+def measure(
+        load: T.Callable[[bytes], T.Any],
+        docs: list[bytes],
+        after: T.Callable[[list], None] | None = None,
+) -> dict:
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    users = [load(raw) for raw in docs]
+    if after is not None:
+        after(users)
+
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "retained_mib": round(current / 2 ** 20, 1),
+        "peak_mib": round(peak / 2 ** 20, 1),
+        "seconds": round(elapsed, 3),
+    }
+
+
+def decode_sent_requests(users: list[models.User]) -> None:
+    for user in users:
+        user.sent_requests
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--sent-requests", type=int, default=20, help="sent requests per user")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    docs = []
+    projected = []
+    for user_id in range(1, args.users + 1):
+        doc = make_doc(user_id, args.sent_requests, rnd)
+        docs.append(bson.encode(doc))
+        projected.append(bson.encode({"_id": doc["_id"], **{f: doc[f] for f in frontend.KEYBOARD_FIELDS}}))
+
+    results = {
+        "commit": get_commit(),
+        "users": args.users,
+        "sent_requests": args.sent_requests,
+        "dataclass": measure(load_dataclass, docs),
+        "slotted": measure(load_slotted, docs),
+        "slotted_decoded": measure(load_slotted, docs, decode_sent_requests),
+        "slotted_projection": measure(load_slotted, projected),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
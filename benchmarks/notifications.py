@@ -0,0 +1,145 @@
+"""
+Benchmark of notifications fan-out.
+
+Creates users who search one language and opted in to notifications,
+then a number of new native speakers join. Measures how fast
+notifications are delivered through the outbox to a fake bot. Telegram
+flood limits are off unless WTB_OUTBOX_GLOBAL_RATE is set:
+
+    python -m benchmarks.notifications --learners 5000 --speakers 3
+"""
+
+import os
+
+# must be set before wtb is imported, see also e2e module
+os.environ.setdefault("TELEGRAM_API_TOKEN", "1:benchmark")
+os.environ.setdefault("WTB_NOTIFY_MAX_RECIPIENTS", "1000000")
+os.environ.setdefault("WTB_OUTBOX_GLOBAL_RATE", "1000000")
+os.environ.setdefault("WTB_OUTBOX_CHAT_INTERVAL", "0")
+
+import json  # noqa: E402
+import time  # noqa: E402
+import asyncio  # noqa: E402
+import argparse  # noqa: E402
+import datetime  # noqa: E402
+
+import telegram  # noqa: E402
+
+from wtb import db  # noqa: E402
+from wtb import asyncdb  # noqa: E402
+from wtb import outbox  # noqa: E402
+from wtb import notifier  # noqa: E402
+from wtb import migrations  # noqa: E402
+
+from .e2e import FakeBot, CommandCounter, connect, get_commit  # noqa: E402
+
+
+LANGUAGE = "German"
+SPEAKER_ID_BASE = 10 ** 9
+
+
+class CountingBot(FakeBot):
+    sent = 0
+
+    async def send_message(self, chat_id: int | str, text: str, *args, **kwargs) -> telegram.Message:
+        CountingBot.sent += 1
+        return await super().send_message(chat_id, text, *args, **kwargs)
+
+
+def populate(learners: int) -> None:
+    now = datetime.datetime.utcnow()
+    users = [
+        {
+            "user_id": user_id,
+            "language": "English",
+            "search_language": LANGUAGE,
+            "notify": True,
+            "pause": False,
+            "created_at": now,
+            "last_updated": now,
+        }
+        for user_id in range(1, learners + 1)
+    ]
+
+    for start in range(0, len(users), 10000):
+        db.get_users_collection().insert_many(users[start:start + 10000])
+
+
+async def run(args: argparse.Namespace, counter: CommandCounter | None) -> dict:
+    bot = CountingBot(os.environ["TELEGRAM_API_TOKEN"])
+    outbox.OUTBOX.start(bot)
+    notifier.NOTIFIER.start()
+
+    expected = args.learners * min(args.speakers, 1 if notifier.NOTIFY_INTERVAL else args.speakers)
+    commands_before = counter.count if counter else 0
+    start = time.perf_counter()
+    submit_times = []
+
+    try:
+        for i in range(args.speakers):
+            # same path as set_native_language + search_language
+            submit_start = time.perf_counter()
+            await asyncdb.update_wtb_user(
+                {"user_id": SPEAKER_ID_BASE + i},
+                {"language": LANGUAGE, "search_language": "English", "pause": False},
+            )
+            submit_times.append(time.perf_counter() - submit_start)
+
+        while CountingBot.sent < expected or notifier.NOTIFIER.qsize() or outbox.OUTBOX.qsize():
+            if time.perf_counter() - start > args.timeout:
+                break
+            await asyncio.sleep(0.01)
+
+        elapsed = time.perf_counter() - start
+    finally:
+        await notifier.NOTIFIER.stop()
+        await outbox.OUTBOX.stop()
+        asyncdb.shutdown()
+
+    return {
+        "delivered": CountingBot.sent,
+        "expected": expected,
+        "seconds": round(elapsed, 3),
+        "notifications_per_sec": round(CountingBot.sent / elapsed, 1),
+        # time spent by the user update which triggers fan-out
+        "trigger_max_ms": round(max(submit_times) * 1000, 3),
+        "mongo_commands_per_notification": (
+            round((counter.count - commands_before) / max(CountingBot.sent, 1), 3) if counter else None
+        ),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--learners", type=int, default=5000, help="number of users waiting for speakers")
+    parser.add_argument("--speakers", type=int, default=3, help="number of new native speakers")
+    parser.add_argument("--timeout", type=float, default=600, help="stop waiting for delivery after seconds")
+    parser.add_argument("--mongo-url", help="real mongo to use instead of mongomock")
+    parser.add_argument("--output", help="write results to this file instead of stdout")
+    args = parser.parse_args()
+
+    counter = connect(args.mongo_url)
+
+    migrations.migrate()
+    populate(args.learners)
+
+    results = {
+        "commit": get_commit(),
+        "learners": args.learners,
+        "speakers": args.speakers,
+        "mongo": "mongodb" if args.mongo_url else "mongomock",
+        "outbox_global_rate": outbox.GLOBAL_RATE,
+        "notify_batch_size": notifier.NOTIFY_BATCH_SIZE,
+        **asyncio.run(run(args, counter)),
+    }
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as out:
+            out.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Flood check of concurrent update processing.
+
+Many simulated users send numbered messages at once through the real
+update queue of the application (see botutils.OrderedApplication). A
+handler sleeps for a random time, so with concurrent processing later
+updates could overtake earlier ones. Checks that every user's updates
+were handled strictly in order of arrival and that processing is
+actually concurrent: the speedup over processing handler times one by
+one should be at least --min-speedup. Exits with an error otherwise.
+
+Mongo isn't touched by the handler, mongomock backs the persistence:
+
+    python -m benchmarks.ordering --users 200 --messages 20
+"""
+
+import os
+
+# must be set before wtb is imported
+os.environ.setdefault("TELEGRAM_API_TOKEN", "1:benchmark")
+os.environ.setdefault("WTB_MONGO_DB", "wtb_benchmark")
+
+import sys  # noqa: E402
+import json  # noqa: E402
+import time  # noqa: E402
+import random  # noqa: E402
+import asyncio  # noqa: E402
+import argparse  # noqa: E402
+
+import telegram  # noqa: E402
+import telegram.ext  # noqa: E402
+
+from wtb import botutils  # noqa: E402
+
+from .e2e import FakeBot, connect, make_update, get_commit  # noqa: E402
+
+
+async def run(args: argparse.Namespace) -> dict:
+    rnd = random.Random(args.seed)
+    bot = FakeBot(os.environ["TELEGRAM_API_TOKEN"])
+    app = botutils.get_application(bot)
+
+    total = args.users * args.messages
+    handled: dict[int, list[int]] = {}
+    delays = [rnd.uniform(0, args.max_delay) for _ in range(total)]
+    done = asyncio.Event()
+
+    async def handle(update: telegram.Update, context: telegram.ext.ContextTypes.DEFAULT_TYPE) -> None:
+        sequence = int(update.message.text)
+        await asyncio.sleep(delays[update.update_id - 1])
+        handled.setdefault(update.effective_user.id, []).append(sequence)
+
+        if sum(map(len, handled.values())) == total:
+            done.set()
+
+    app.add_handler(telegram.ext.TypeHandler(telegram.Update, handle))
+
+    # messages of different users are interleaved like real traffic
+    updates = []
+    for sequence in range(args.messages):
+        for user_id in range(1, args.users + 1):
+            updates.append(make_update(bot, len(updates) + 1, user_id, str(sequence)))
+
+    async with app:
+        await app.start()
+        start = time.perf_counter()
+
+        for update in updates:
+            await app.update_queue.put(update)
+
+        await asyncio.wait_for(done.wait(), args.timeout)
+        elapsed = time.perf_counter() - start
+        await app.stop()
+
+    out_of_order = sorted(
+        user_id
+        for user_id, sequences in handled.items()
+        if sequences != list(range(args.messages))
+    )
+    speedup = sum(delays) / elapsed
+
+    return {
+        "updates": total,
+        "seconds": round(elapsed, 3),
+        "updates_per_sec": round(total / elapsed, 1),
+        "speedup": round(speedup, 1),
+        "users_out_of_order": len(out_of_order),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200, help="number of simulated users")
+    parser.add_argument("--messages", type=int, default=20, help="number of messages sent by every user")
+    parser.add_argument("--max-delay", type=float, default=0.01, help="max handler duration in seconds")
+    parser.add_argument("--min-speedup", type=float, default=2.0, help="fail if processing is less concurrent")
+    parser.add_argument("--timeout", type=float, default=300, help="stop waiting for processing after seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    connect(None)
+
+    results = {
+        "commit": get_commit(),
+        "users": args.users,
+        "messages": args.messages,
+        "concurrent_updates": botutils.CONCURRENT_UPDATES,
+        **asyncio.run(run(args)),
+    }
+    print(json.dumps(results, indent=2))
+
+    if results["users_out_of_order"]:
+        sys.exit(f"Updates of {results['users_out_of_order']} users were handled out of order")
+
+    if results["speedup"] < args.min_speedup:
+        sys.exit(f"Updates aren't processed concurrently: speedup is {results['speedup']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Load test of the async db layer against a slow mongo stand-in.
+
+mongomock collections are wrapped so that every operation takes
+--latency seconds, like a round-trip to a loaded server. Concurrent
+update_wtb_user calls are made for different users, the way concurrent
+updates call them:
+
+- blocking: db functions are called right on the event loop, as handlers
+  did before asyncdb existed, so calls complete one by one;
+- asyncdb: calls are awaited through asyncdb and complete in parallel,
+  up to WTB_DB_WORKERS at a time.
+
+Event loop lag (how late a 1ms timer fires) shows whether other updates
+could be processed meanwhile:
+
+    python -m benchmarks.slowmongo --calls 200 --latency 0.02
+"""
+
+import os
+
+# must be set before wtb is imported
+os.environ.setdefault("TELEGRAM_API_TOKEN", "1:benchmark")
+os.environ.setdefault("WTB_MONGO_DB", "wtb_benchmark")
+
+import json  # noqa: E402
+import time  # noqa: E402
+import asyncio  # noqa: E402
+import argparse  # noqa: E402
+import functools  # noqa: E402
+import typing as T  # noqa: E402
+
+import pymongo.collection  # noqa: E402
+
+from wtb import db  # noqa: E402
+from wtb import asyncdb  # noqa: E402
+
+from .e2e import LANGUAGES, connect, get_commit  # noqa: E402
+
+
+class SlowCollection:
+    """
+    Collection proxy which sleeps before every operation
+    """
+
+    def __init__(self, collection: pymongo.collection.Collection, latency: float):
+        self._collection = collection
+        self._latency = latency
+
+    def __getattr__(self, name: str) -> T.Any:
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def wrapper(*args, **kwargs):
+            time.sleep(self._latency)
+            return attr(*args, **kwargs)
+
+        return wrapper
+
+
+def slow_down(latency: float) -> None:
+    get_users_collection = db.get_users_collection
+    db.get_users_collection = lambda: SlowCollection(get_users_collection(), latency)
+    db._get_raw_users_collection = db.get_users_collection
+
+
+async def measure_lag(stop: asyncio.Event) -> float:
+    """
+    Return max delay of a 1ms timer until *stop* is set
+    """
+    loop = asyncio.get_running_loop()
+    max_lag = 0.0
+
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(0.001)
+        max_lag = max(max_lag, loop.time() - start - 0.001)
+
+    return max_lag
+
+
+async def run_mode(mode: str, user_ids: range) -> dict:
+    # cached users would skip the writes
+    db.USER_CACHE.clear()
+
+    async def update(user_id: int) -> None:
+        user = {"user_id": user_id}
+        extra = {"search_language": LANGUAGES[user_id % len(LANGUAGES)], "pause": False}
+
+        if mode == "blocking":
+            db.update_wtb_user(user, extra)
+        else:
+            await asyncdb.update_wtb_user(user, extra)
+
+    stop = asyncio.Event()
+    lag = asyncio.create_task(measure_lag(stop))
+    await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    await asyncio.gather(*map(update, user_ids))
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    max_lag = await lag
+
+    return {
+        "seconds": round(elapsed, 3),
+        "calls_per_sec": round(len(user_ids) / elapsed, 1),
+        "max_loop_lag_ms": round(max_lag * 1000, 1),
+    }
+
+
+async def run(args: argparse.Namespace) -> dict:
+    user_ids = range(1, args.calls + 1)
+    results = {}
+
+    for mode in ("blocking", "asyncdb"):
+        results[mode] = await run_mode(mode, user_ids)
+
+    asyncdb.shutdown()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=200, help="number of concurrent update_wtb_user calls")
+    parser.add_argument("--latency", type=float, default=0.02, help="duration of every mongo operation in seconds")
+    args = parser.parse_args()
+
+    connect(None)
+    slow_down(args.latency)
+
+    results = {
+        "commit": get_commit(),
+        "calls": args.calls,
+        "latency_ms": args.latency * 1000,
+        "db_workers": asyncdb.DB_WORKERS,
+        **asyncio.run(run(args)),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
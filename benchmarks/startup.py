@@ -0,0 +1,74 @@
+"""
+Startup time of the language tables.
+
+Compares loading the precompiled artifact (langsdb._load_artifact) with
+parsing language-codes.csv and building the tables, medians of --repeat
+runs. Also reports how long `import wtb.langsdb` takes in a fresh
+interpreter, which is what every bot process pays:
+
+    python -m benchmarks.startup --repeat 50
+"""
+
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+import typing as T
+
+from wtb import langsdb
+
+from .e2e import get_commit
+
+
+def time_calls(func: T.Callable[[], T.Any], repeat: int) -> float:
+    """
+    Return median duration in milliseconds
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+
+    return round(statistics.median(durations) * 1000, 3)
+
+
+def build_from_csv() -> None:
+    langsdb._build_long_langs()
+    langsdb._build_index()
+
+
+def time_import(repeat: int) -> float:
+    """
+    Return median duration of `import wtb.langsdb` in a fresh interpreter in milliseconds
+    """
+    code = "import time; start = time.perf_counter(); import wtb.langsdb; print(time.perf_counter() - start)"
+    durations = [
+        float(subprocess.check_output([sys.executable, "-c", code], text=True))
+        for _ in range(repeat)
+    ]
+
+    return round(statistics.median(durations) * 1000, 3)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=50, help="runs of every measurement")
+    args = parser.parse_args()
+
+    # make sure the artifact is fresh, otherwise _load_artifact returns None
+    langsdb.compile_artifact()
+
+    results = {
+        "commit": get_commit(),
+        "artifact_load_ms": time_calls(langsdb._load_artifact, args.repeat),
+        "csv_parse_ms": time_calls(build_from_csv, args.repeat),
+        "import_ms": time_import(min(args.repeat, 10)),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
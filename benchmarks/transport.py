@@ -0,0 +1,254 @@
+"""
+Updates per second in polling and webhook modes.
+
+Telegram Bot API is faked in memory (FakeTelegram): getUpdates serves
+recorded updates in batches, other methods succeed. In polling mode the
+application's updater fetches updates from it; in webhook mode updates
+are POSTed to the updater's webhook server over HTTP with up to
+--connections requests at a time and updates of one chat one by one,
+like telegram does. Updates go through the real handlers, mongo is
+mongomock (fresh database per mode).
+
+Updates are either recorded ones (--updates, a JSON list of updates as
+sent by telegram) or generated: simulated users going through the e2e
+flow.
+
+    python -m benchmarks.transport --users 100 --mode polling --mode webhook
+"""
+
+import os
+
+# must be set before wtb is imported
+os.environ.setdefault("TELEGRAM_API_TOKEN", "1:benchmark")
+os.environ.setdefault("WTB_MONGO_DB", "wtb_benchmark")
+os.environ.setdefault("WTB_METRICS_PORT", "0")
+# telegram flood limits don't apply to the fake api
+os.environ.setdefault("WTB_OUTBOX_GLOBAL_RATE", "1000000")
+os.environ.setdefault("WTB_OUTBOX_CHAT_INTERVAL", "0")
+
+import json  # noqa: E402
+import time  # noqa: E402
+import bisect  # noqa: E402
+import random  # noqa: E402
+import socket  # noqa: E402
+import asyncio  # noqa: E402
+import argparse  # noqa: E402
+import itertools  # noqa: E402
+
+import httpx  # noqa: E402
+import telegram  # noqa: E402
+import telegram.ext  # noqa: E402
+import telegram.request  # noqa: E402
+
+from wtb import db  # noqa: E402
+from wtb import botutils  # noqa: E402
+from wtb import frontend  # noqa: E402
+from wtb import migrations  # noqa: E402
+
+from .e2e import FLOW, LANGUAGES, NATIVE_LANGUAGE, SEARCH_LANGUAGE, connect, make_update_data, get_commit  # noqa: E402
+
+
+MODES = (botutils.MODE_POLLING, botutils.MODE_WEBHOOK)
+WEBHOOK_PATH = "webhook"
+WEBHOOK_SECRET = "benchmark"
+
+
+class FakeTelegram(telegram.request.BaseRequest):
+    """
+    Bot API served from memory
+    """
+
+    def __init__(self, updates: list[dict]):
+        self._updates = updates
+        self._update_ids = [u["update_id"] for u in updates]
+        self._message_ids = itertools.count(1)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(
+            self,
+            url: str,
+            method: str,
+            request_data: telegram.request.RequestData | None = None,
+            read_timeout=None,
+            write_timeout=None,
+            connect_timeout=None,
+            pool_timeout=None,
+    ) -> tuple[int, bytes]:
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+
+        if api_method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Benchmark", "username": "wtb_benchmark_bot"}
+        elif api_method == "getUpdates":
+            result = await self._get_updates(params)
+        elif api_method == "sendMessage":
+            result = {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(params["chat_id"]), "type": "private"},
+                "text": params["text"],
+            }
+        else:
+            result = True
+
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    async def _get_updates(self, params: dict) -> list[dict]:
+        start = bisect.bisect_left(self._update_ids, int(params.get("offset") or 0))
+        updates = self._updates[start:start + int(params.get("limit") or 100)]
+
+        if not updates:
+            # long polling, nothing is coming
+            await asyncio.sleep(0.05)
+
+        return updates
+
+
+def generate_updates(users: int, rnd: random.Random) -> list[dict]:
+    update_ids = itertools.count(1)
+    languages = [rnd.sample(LANGUAGES, 2) for _ in range(users)]
+    updates = []
+
+    for step, text in FLOW:
+        for user_id, (language, search_language) in enumerate(languages, start=1):
+            if text is NATIVE_LANGUAGE:
+                update_text = language
+            elif text is SEARCH_LANGUAGE:
+                update_text = search_language
+            else:
+                update_text = text
+            updates.append(make_update_data(next(update_ids), user_id, update_text))
+
+    return updates
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def post_updates(updates: list[dict], port: int, connections: int) -> None:
+    url = f"http://127.0.0.1:{port}/{WEBHOOK_PATH}"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET}
+    semaphore = asyncio.Semaphore(connections)
+
+    # telegram sends updates of one chat one by one
+    chats: dict[int, list[dict]] = {}
+    for update in updates:
+        chats.setdefault(update["message"]["chat"]["id"], []).append(update)
+
+    async with httpx.AsyncClient(limits=httpx.Limits(max_connections=connections)) as client:
+        async def post(chat_updates: list[dict]) -> None:
+            for update in chat_updates:
+                async with semaphore:
+                    response = await client.post(url, json=update, headers=headers)
+                    response.raise_for_status()
+
+        await asyncio.gather(*map(post, chats.values()))
+
+
+async def run_mode(mode: str, updates: list[dict], args: argparse.Namespace) -> dict:
+    connect(None)
+    migrations.migrate()
+    db.USER_CACHE.clear()
+
+    fake = FakeTelegram(updates)
+    bot = telegram.ext.ExtBot(os.environ["TELEGRAM_API_TOKEN"], request=fake, get_updates_request=fake)
+    app = botutils.get_application(bot)
+    frontend.add_handlers(app)
+
+    processed = 0
+    done = asyncio.Event()
+
+    async def count(update: telegram.Update, context: telegram.ext.ContextTypes.DEFAULT_TYPE) -> None:
+        nonlocal processed
+        processed += 1
+        if processed == len(updates):
+            done.set()
+
+    # groups are handled one by one, so it runs after the bot's handlers
+    app.add_handler(telegram.ext.TypeHandler(telegram.Update, count), group=1)
+
+    async with app:
+        await app.post_init(app)
+        try:
+            await app.start()
+
+            if mode == botutils.MODE_POLLING:
+                start = time.perf_counter()
+                await app.updater.start_polling(timeout=1)
+            else:
+                port = get_free_port()
+                await app.updater.start_webhook(
+                    listen="127.0.0.1",
+                    port=port,
+                    url_path=WEBHOOK_PATH,
+                    webhook_url=f"http://127.0.0.1:{port}/{WEBHOOK_PATH}",
+                    secret_token=WEBHOOK_SECRET,
+                )
+                start = time.perf_counter()
+                await post_updates(updates, port, args.connections)
+
+            await asyncio.wait_for(done.wait(), args.timeout)
+            elapsed = time.perf_counter() - start
+
+            await app.updater.stop()
+            await app.stop()
+        finally:
+            await app.post_shutdown(app)
+
+    return {
+        "seconds": round(elapsed, 3),
+        "updates_per_sec": round(len(updates) / elapsed, 1),
+    }
+
+
+async def run(updates: list[dict], args: argparse.Namespace) -> dict:
+    results = {}
+    for mode in args.mode or MODES:
+        results[mode] = await run_mode(mode, updates, args)
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=MODES, action="append", help="mode to benchmark, both by default")
+    parser.add_argument("--updates", help="JSON file with recorded updates instead of generated ones")
+    parser.add_argument("--users", type=int, default=100, help="number of simulated users for generated updates")
+    parser.add_argument("--connections", type=int, default=40, help="concurrent webhook requests")
+    parser.add_argument("--timeout", type=float, default=600, help="stop waiting for processing after seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results to this file instead of stdout")
+    args = parser.parse_args()
+
+    if args.updates:
+        with open(args.updates) as updates_file:
+            updates = sorted(json.load(updates_file), key=lambda u: u["update_id"])
+    else:
+        updates = generate_updates(args.users, random.Random(args.seed))
+
+    results = {
+        "commit": get_commit(),
+        "updates": len(updates),
+        "mongo": "mongomock",
+        "concurrent_updates": botutils.CONCURRENT_UPDATES,
+        **asyncio.run(run(updates, args)),
+    }
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as out:
+            out.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,4 +7,7 @@ if [ ! -f token ]; then
     exit 1
 fi
 
+# use COMPOSE_PROFILES=multi to run several workers, see docker-compose.yml
+export COMPOSE_PROFILES=${COMPOSE_PROFILES:-single}
+
 docker build -t wtb:latest . && TELEGRAM_API_TOKEN=`cat token` docker compose up $@
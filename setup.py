@@ -30,6 +30,9 @@ setuptools.setup(
     entry_points={
         'console_scripts': [
             'wtb-bot = wtb.frontend:main',
+            'wtb-migrate = wtb.migrations:main',
+            'wtb-router = wtb.router:main',
+            'wtb-compact-messages = wtb.messagelog:main',
         ],
     },
 )
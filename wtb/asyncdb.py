@@ -0,0 +1,297 @@
+"""
+Async facade for the db module.
+
+pymongo is synchronous, so every call is shipped to a bounded thread pool
+and awaited from the event loop. This way one slow Mongo round-trip blocks
+only a single worker thread instead of every update being processed.
+
+Collection getters from db module are not wrapped: they don't do any I/O.
+
+Calls go through a circuit breaker: after BREAKER_THRESHOLD connection
+failures in a row DatabaseUnavailable is raised immediately for
+BREAKER_RESET_TIMEOUT seconds, then a single trial call is let through.
+While the database is unavailable users are served from cache (degraded
+mode) and user writes are postponed and replayed in order on recovery.
+"""
+
+import os
+import time
+import datetime
+import asyncio
+import functools
+import collections
+import concurrent.futures
+import typing as T
+
+import pymongo.errors
+
+from . import logconfig
+from . import db
+from . import models
+from . import metrics
+
+logger = logconfig.logger
+
+
+DB_WORKERS = int(os.environ.get("WTB_DB_WORKERS", "10"))
+
+BREAKER_THRESHOLD = int(os.environ.get("WTB_DB_BREAKER_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.environ.get("WTB_DB_BREAKER_RESET_TIMEOUT", "10"))
+# max number of writes postponed while the database is unavailable
+MAX_DEFERRED_WRITES = int(os.environ.get("WTB_DB_MAX_DEFERRED_WRITES", "10000"))
+
+_EXECUTOR: concurrent.futures.ThreadPoolExecutor | None = None
+
+_RESULT_VAR = T.TypeVar("_RESULT_VAR")
+
+
+class DatabaseUnavailable(Exception):
+    """
+    Raised instead of calling the database while circuit breaker is open
+    """
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+
+    def check(self) -> None:
+        """
+        Raise DatabaseUnavailable unless a call is allowed
+        """
+        if self.state == self.CLOSED:
+            return
+
+        if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN  # let a single trial call through
+            return
+
+        raise DatabaseUnavailable()
+
+    def record_success(self) -> None:
+        if self.state != self.CLOSED:
+            logger.info("Database is available again")
+
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+
+        if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+            if self.state == self.CLOSED:
+                logger.error("Database is unavailable, switching to degraded mode")
+
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+
+    def record_unknown(self) -> None:
+        """
+        Call outcome is unknown: trial call is given to the next attempt
+        """
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+
+
+BREAKER = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_RESET_TIMEOUT)
+
+# (func, args, kwargs) of postponed writes in order
+_DEFERRED: collections.deque[tuple[T.Callable, tuple, dict]] = collections.deque()
+_REPLAY_TASK: asyncio.Task | None = None
+
+metrics.Callback(
+    "wtb_db_breaker_open",
+    "1 if the database is considered unavailable",
+    lambda: int(BREAKER.state != CircuitBreaker.CLOSED),
+)
+metrics.Callback(
+    "wtb_db_deferred_writes",
+    "Number of writes postponed until the database is available",
+    lambda: len(_DEFERRED),
+)
+
+
+def get_executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _EXECUTOR
+
+    if _EXECUTOR is None:
+        _EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+            max_workers=DB_WORKERS,
+            thread_name_prefix="wtb-db",
+        )
+
+    return _EXECUTOR
+
+
+async def run(func: T.Callable[..., _RESULT_VAR], *args, **kwargs) -> _RESULT_VAR:
+    """
+    Run blocking *func* in the db thread pool and return its result
+    """
+    BREAKER.check()
+
+    loop = asyncio.get_running_loop()
+    try:
+        result = await loop.run_in_executor(
+            get_executor(),
+            functools.partial(func, *args, **kwargs),
+        )
+    except pymongo.errors.ConnectionFailure:
+        BREAKER.record_failure()
+        raise
+    except pymongo.errors.OperationFailure:
+        # server has answered, so it's available
+        BREAKER.record_success()
+        raise
+    except BaseException:
+        # cancelled or failed before reaching the server, tells nothing
+        BREAKER.record_unknown()
+        raise
+
+    BREAKER.record_success()
+    return result
+
+
+def _defer(func: T.Callable, *args, **kwargs) -> None:
+    if len(_DEFERRED) >= MAX_DEFERRED_WRITES:
+        logger.error("Too many postponed writes, dropping %s", func.__name__)
+        return
+
+    _DEFERRED.append((func, args, kwargs))
+    # replay waits until the database is back
+    _start_replay()
+
+
+def _start_replay() -> None:
+    global _REPLAY_TASK
+
+    if _REPLAY_TASK is None or _REPLAY_TASK.done():
+        _REPLAY_TASK = asyncio.create_task(_replay())
+
+
+async def _replay() -> None:
+    while _DEFERRED:
+        func, args, kwargs = _DEFERRED[0]
+        try:
+            await run(func, *args, **kwargs)
+        except (DatabaseUnavailable, pymongo.errors.ConnectionFailure):
+            await asyncio.sleep(BREAKER_RESET_TIMEOUT)
+            continue
+        except Exception:
+            logger.exception("Failed to replay %s", func.__name__)
+
+        _DEFERRED.popleft()
+
+
+async def write(func: T.Callable, *args, **kwargs) -> bool:
+    """
+    Run write *func*, postpone it if the database is unavailable or there
+    are postponed writes already (to keep the order). Return True if the
+    write is done.
+    """
+    if not _DEFERRED:
+        try:
+            await run(func, *args, **kwargs)
+            return True
+        except (DatabaseUnavailable, pymongo.errors.ConnectionFailure):
+            pass
+
+    _defer(func, *args, **kwargs)
+    return False
+
+
+def shutdown() -> None:
+    global _EXECUTOR
+
+    if _REPLAY_TASK is not None:
+        _REPLAY_TASK.cancel()
+
+    if _DEFERRED:
+        logger.error("%s postponed writes are lost", len(_DEFERRED))
+
+    if _EXECUTOR is not None:
+        _EXECUTOR.shutdown(wait=True)
+        _EXECUTOR = None
+
+
+async def count_language(lang: str) -> int:
+    return await run(db.count_language, lang)
+
+
+async def update_wtb_user(user, extra) -> models.User:
+    """
+    In degraded mode the write is postponed and cached user is updated
+    """
+    if not _DEFERRED:
+        try:
+            return await run(db.update_wtb_user, user, extra)
+        except (DatabaseUnavailable, pymongo.errors.ConnectionFailure):
+            pass
+
+    # replayed write should reach the database even if cached user is the same
+    _defer(db.update_wtb_user, user, extra, force=True)
+    return db.cache_user_update(user, extra)
+
+
+async def add_sent_request(user_id: int, to_user_id: int, language: str) -> None:
+    if not await write(db.add_sent_request, user_id, to_user_id, language):
+        # replayed write updates the cache again, duplicate entry is harmless
+        # as contacted users are a set, and it's gone once the user is fetched
+        db.cache_sent_request(user_id, to_user_id, language)
+
+
+async def touch_user(user_id: int) -> None:
+    """
+    Refresh user's last_seen at most once in db.LAST_SEEN_INTERVAL, skipped
+    while the database is unavailable
+    """
+    if db.is_seen_recently(user_id):
+        return
+
+    try:
+        await run(db.touch_user, user_id)
+    except (DatabaseUnavailable, pymongo.errors.ConnectionFailure):
+        pass
+
+
+async def get_user(user_id: int, fields: T.Iterable[str] | None = None) -> models.User | None:
+    """
+    In degraded mode cached (possibly expired) user is returned, if there is
+    none DatabaseUnavailable is raised: the user may exist all the same
+    """
+    try:
+        return await run(db.get_user, user_id, fields)
+    except (DatabaseUnavailable, pymongo.errors.ConnectionFailure) as exc:
+        wtb_user = db.USER_CACHE.peek(user_id, stale=True)
+        if wtb_user is None:
+            raise DatabaseUnavailable() from exc
+
+        return wtb_user
+
+
+async def get_pair(skip_users: list[int], language: str) -> dict | None:
+    return await run(db.get_pair, skip_users, language)
+
+
+async def get_reciprocal_pair(skip_users: list[int], language: str, search_language: str) -> dict | None:
+    return await run(db.get_reciprocal_pair, skip_users, language, search_language)
+
+
+async def get_active_user_ids(
+        after_user_id: int,
+        limit: int,
+        seen_before: datetime.datetime | None = None,
+) -> list[int]:
+    return await run(db.get_active_user_ids, after_user_id, limit, seen_before)
+
+
+async def get_inactive_users(days: float, limit: int) -> list[dict]:
+    return await run(db.get_inactive_users, days, limit)
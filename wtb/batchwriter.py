@@ -0,0 +1,172 @@
+"""
+Buffered writer which stores documents to mongo in batches.
+
+Documents are put into a bounded in-memory queue and a background task
+drains it with insert_many once batch size or flush interval is reached.
+While the database is unavailable (see asyncdb circuit breaker) or the
+connection fails a batch is retried instead of being lost: insert_many sets
+_id of the documents before sending them, so documents which were inserted
+by a failed attempt are reported as duplicates on retry and skipped.
+"""
+
+import asyncio
+import typing as T
+
+import pymongo.errors
+import pymongo.collection
+
+from . import logconfig
+from . import asyncdb
+
+logger = logconfig.logger
+
+
+# what to do when queue is full
+POLICY_DROP = "drop"
+POLICY_BLOCK = "block"
+
+_STOP = object()
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+class BatchWriter:
+    def __init__(
+            self,
+            name: str,
+            get_collection: T.Callable[[], pymongo.collection.Collection],
+            max_queue_size: int = 10000,
+            batch_size: int = 100,
+            flush_interval: float = 1.0,
+            policy: str = POLICY_DROP,
+    ):
+        if policy not in (POLICY_DROP, POLICY_BLOCK):
+            raise ValueError(f"Unknown queue policy: {policy}")
+
+        self.name = name
+        self.get_collection = get_collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue_size)
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    async def put(self, doc: dict) -> None:
+        if self.policy == POLICY_BLOCK:
+            await self._queue.put(doc)
+            return
+
+        try:
+            self._queue.put_nowait(doc)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            # don't flood the log, one line per thousand lost documents is enough
+            if self.dropped % 1000 == 1:
+                logger.warning(
+                    "Write queue of %s is full, %s documents dropped so far",
+                    self.name,
+                    self.dropped,
+                )
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Flush everything which was queued so far and stop the background task
+        """
+        if self._task is None:
+            return
+
+        self._stopping = True
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+        self._stopping = False
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+
+        while True:
+            doc = await self._queue.get()
+            if doc is _STOP:
+                return
+
+            batch = [doc]
+            deadline = loop.time() + self.flush_interval
+            stop = False
+
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+
+                try:
+                    doc = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+                if doc is _STOP:
+                    stop = True
+                    break
+
+                batch.append(doc)
+
+            await self._flush(batch)
+
+            if stop:
+                return
+
+    async def _flush(self, batch: list[dict]) -> None:
+        while True:
+            try:
+                await asyncdb.run(self._insert, batch)
+            except pymongo.errors.ConnectionFailure:
+                # retry is safe, see _insert; if failures go on the breaker
+                # opens and the next branch applies
+                logger.warning("Failed to write %s documents to %s, retrying", len(batch), self.name)
+                continue
+            except asyncdb.DatabaseUnavailable:
+                # new documents are queued (or dropped) meanwhile
+                if self._stopping:
+                    self.failed += len(batch)
+                    logger.error("Database is unavailable, %s documents to %s are lost", len(batch), self.name)
+                    return
+
+                await asyncio.sleep(asyncdb.BREAKER_RESET_TIMEOUT)
+                continue
+            except Exception:
+                self.failed += len(batch)
+                logger.exception(
+                    "Failed to write %s documents to %s",
+                    len(batch),
+                    self.name,
+                )
+            else:
+                self.written += len(batch)
+
+            return
+
+    def _insert(self, batch: list[dict]) -> None:
+        try:
+            self.get_collection().insert_many(batch, ordered=False)
+        except pymongo.errors.BulkWriteError as exc:
+            # the rest of the batch is inserted anyway as it's unordered
+            if any(error["code"] != DUPLICATE_KEY_ERROR for error in exc.details["writeErrors"]):
+                raise
+
+            logger.info(
+                "%s documents to %s were written by a failed attempt already",
+                len(exc.details["writeErrors"]),
+                self.name,
+            )
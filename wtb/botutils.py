@@ -3,6 +3,8 @@ Common staff for bot interaction
 """
 
 import os
+import time
+import asyncio
 import functools
 import datetime
 import typing as T
@@ -12,48 +14,246 @@ import telegram.ext
 
 from . import logconfig
 from . import db
+from . import asyncdb
+from . import batchwriter
+from . import events
+from . import messagelog
+from . import notifier
+from . import metrics
+from . import outbox
+from . import persistence
+from . import webhookconfig
 
 logger = logconfig.logger
 
 
 TELEGRAM_API_TOKEN = os.environ["TELEGRAM_API_TOKEN"]
 
+# how updates are received: long polling or webhook
+MODE_POLLING = "polling"
+MODE_WEBHOOK = "webhook"
+BOT_MODE = os.environ.get("WTB_MODE", MODE_POLLING)
 
-def get_application() -> telegram.ext.Application:
+# webhook mode settings, TLS is expected to be terminated by a proxy in front of the bot
+WEBHOOK_LISTEN = os.environ.get("WTB_WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WTB_WEBHOOK_PORT", "8443"))
+# public URL registered at telegram, must end with webhookconfig.WEBHOOK_PATH
+WEBHOOK_URL = os.environ.get("WTB_WEBHOOK_URL")
+
+# number of updates which are processed at the same time
+CONCURRENT_UPDATES = int(os.environ.get("WTB_CONCURRENT_UPDATES", "16"))
+# number of updates which could wait for processing, includes updates
+# waiting for previous update of the same user
+PENDING_UPDATES = int(os.environ.get("WTB_PENDING_UPDATES", "4096"))
+
+MESSAGE_LOG_WRITER = batchwriter.BatchWriter(
+    "messages",
+    db.get_messages_collection,
+    max_queue_size=int(os.environ.get("WTB_LOG_QUEUE_SIZE", "10000")),
+    batch_size=int(os.environ.get("WTB_LOG_BATCH_SIZE", "100")),
+    flush_interval=float(os.environ.get("WTB_LOG_FLUSH_INTERVAL", "1.0")),
+    policy=os.environ.get("WTB_LOG_QUEUE_POLICY", batchwriter.POLICY_DROP),
+)
+
+HANDLER_LATENCY = metrics.Histogram(
+    "wtb_handler_seconds",
+    "Duration of update handlers",
+    labels=("handler",),
+)
+
+metrics.Callback(
+    "wtb_queue_size",
+    "Number of items waiting in background queues",
+    lambda: {
+        ("outbox",): outbox.OUTBOX.qsize(),
+        ("message_log",): MESSAGE_LOG_WRITER.qsize(),
+        ("events",): events.EVENT_WRITER.qsize(),
+        ("notifications",): notifier.NOTIFIER.qsize(),
+    },
+    labels=("queue",),
+)
+
+metrics.Callback(
+    "wtb_message_log_total",
+    "Logged messages by result",
+    lambda: {
+        ("written",): MESSAGE_LOG_WRITER.written,
+        ("dropped",): MESSAGE_LOG_WRITER.dropped,
+        ("failed",): MESSAGE_LOG_WRITER.failed,
+    },
+    labels=("result",),
+    kind="counter",
+)
+
+
+class _UserLock:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class OrderedApplication(telegram.ext.Application):
+    """
+    Application which processes updates of different users concurrently,
+    but updates of the same user strictly one by one in order of arrival,
+    so conversation states stay consistent.
+
+    Relies on FIFO order of asyncio.Lock waiters: update tasks are created
+    in order of arrival and acquire the lock as their first step.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._processing_semaphore = asyncio.Semaphore(CONCURRENT_UPDATES)
+        self._user_locks: dict[int, _UserLock] = {}
+
+    async def process_update(self, update: object) -> None:
+        key = None
+        if isinstance(update, telegram.Update):
+            if update.effective_user:
+                key = update.effective_user.id
+            elif update.effective_chat:
+                key = update.effective_chat.id
+
+        if key is None:
+            async with self._processing_semaphore:
+                await super().process_update(update)
+            return
+
+        user_lock = self._user_locks.get(key)
+        if user_lock is None:
+            user_lock = self._user_locks[key] = _UserLock()
+
+        user_lock.users += 1
+        try:
+            # user lock goes first so waiting updates of one user don't hold processing slots
+            async with user_lock.lock, self._processing_semaphore:
+                await super().process_update(update)
+        finally:
+            user_lock.users -= 1
+            if not user_lock.users:
+                del self._user_locks[key]
+
+
+async def _post_init(app: telegram.ext.Application) -> None:
+    MESSAGE_LOG_WRITER.start()
+    events.EVENT_WRITER.start()
+    outbox.OUTBOX.start(app.bot)
+    notifier.NOTIFIER.start()
+    metrics.start_server()
+
+
+async def _post_shutdown(app: telegram.ext.Application) -> None:
+    await notifier.NOTIFIER.stop()
+    await outbox.OUTBOX.stop()
+    await MESSAGE_LOG_WRITER.stop()
+    await events.EVENT_WRITER.stop()
+    asyncdb.shutdown()
+    metrics.stop_server()
+
+
+def get_application(bot: telegram.Bot | None = None) -> telegram.ext.Application:
     """
-    Initialize and return telegram application
+    Initialize and return telegram application, *bot* replaces the default one
     """
+    builder = telegram.ext.ApplicationBuilder()
+    if bot is None:
+        builder = builder.token(TELEGRAM_API_TOKEN)
+    else:
+        builder = builder.bot(bot)
+
     return (
-        telegram.ext.ApplicationBuilder()
-        .token(TELEGRAM_API_TOKEN)
+        builder
+        .application_class(OrderedApplication)
+        .concurrent_updates(PENDING_UPDATES)
+        .persistence(persistence.MongoPersistence())
+        .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
         .build()
     )
 
 
+def run_application(app: telegram.ext.Application) -> None:
+    """
+    Run the bot until Ctrl-C or SIGINT, SIGTERM or SIGABRT is received.
+
+    Switching between modes is safe: polling deletes registered webhook
+    on start and webhook mode replaces it.
+    """
+    if BOT_MODE == MODE_POLLING:
+        app.run_polling()
+    elif BOT_MODE == MODE_WEBHOOK:
+        if not WEBHOOK_URL:
+            raise ValueError("WTB_WEBHOOK_URL must be set in webhook mode")
+
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=webhookconfig.WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=webhookconfig.WEBHOOK_SECRET,
+        )
+    else:
+        raise ValueError(f"Unknown bot mode: {BOT_MODE}")
+
+
 _HANDLER_RETURN_VAR = T.TypeVar("_HANDLER_RETURN_VAR")
 _HANDLER_TYPE = T.Callable[
     [
         telegram.Update,
         telegram.ext.ContextTypes.DEFAULT_TYPE,
     ],
-    _HANDLER_RETURN_VAR,
+    T.Awaitable[_HANDLER_RETURN_VAR],
 ]
 
 
 def log_message(wrapped: _HANDLER_TYPE) -> _HANDLER_TYPE:
+    """
+    Store a slim record of incoming message once the handler is done with it
+    and refresh user's last_seen.
+
+    Messages are written in background by MESSAGE_LOG_WRITER.
+    """
     @functools.wraps(wrapped)
-    def wrapper(
+    async def wrapper(
             update: telegram.Update,
             context: telegram.ext.ContextTypes.DEFAULT_TYPE,
     ) -> _HANDLER_RETURN_VAR:
+        start = time.perf_counter()
         try:
-            return wrapped(update, context)
+            return await wrapped(update, context)
         finally:
             try:
-                message = update.message.to_dict()
-                message["date"] = datetime.datetime.utcnow()
-                db.get_messages_collection().insert_one(message)
+                message = update.message
+                await MESSAGE_LOG_WRITER.put(messagelog.make_record(
+                    message_id=message.message_id,
+                    chat_id=message.chat_id,
+                    user_id=message.from_user.id if message.from_user else None,
+                    text=message.text,
+                    handler=wrapped.__name__,
+                    duration_ms=round((time.perf_counter() - start) * 1000, 3),
+                    date=datetime.datetime.utcnow(),
+                ))
+                if message.from_user:
+                    await asyncdb.touch_user(message.from_user.id)
             except Exception:
                 logger.exception("Failed to log message:\n%s", update.message)
 
     return wrapper
+
+
+def track_latency(wrapped: _HANDLER_TYPE) -> _HANDLER_TYPE:
+    """
+    Observe handler duration in HANDLER_LATENCY, should be the outermost decorator
+    """
+    @functools.wraps(wrapped)
+    async def wrapper(
+            update: telegram.Update,
+            context: telegram.ext.ContextTypes.DEFAULT_TYPE,
+    ) -> _HANDLER_RETURN_VAR:
+        with HANDLER_LATENCY.time(handler=wrapped.__name__):
+            return await wrapped(update, context)
+
+    return wrapper
@@ -0,0 +1,96 @@
+"""
+Process-local caches.
+"""
+
+import time
+import threading
+import collections
+import typing as T
+
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache with entries expiring after *ttl* seconds.
+
+    Expired entries are counted as evictions.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        # key -> (expiration time, value), most recently used at the end
+        self._data: collections.OrderedDict[T.Hashable, tuple[float, T.Any]] = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _get(self, key: T.Hashable, stale: bool = False) -> T.Any:
+        item = self._data.get(key)
+        if item is None:
+            return _MISSING
+
+        expires, value = item
+        if expires < time.monotonic() and not stale:
+            del self._data[key]
+            self.evictions += 1
+            return _MISSING
+
+        self._data.move_to_end(key)
+        return value
+
+    def get(self, key: T.Hashable, default: T.Any = None) -> T.Any:
+        with self._lock:
+            value = self._get(key)
+
+            if value is _MISSING:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            return value
+
+    def peek(self, key: T.Hashable, default: T.Any = None, stale: bool = False) -> T.Any:
+        """
+        Same as get, but doesn't affect hit/miss counters. With *stale*
+        expired (but not yet evicted) value is returned as well.
+        """
+        with self._lock:
+            value = self._get(key, stale)
+            return default if value is _MISSING else value
+
+    def set(self, key: T.Hashable, value: T.Any) -> None:
+        if not self.maxsize:
+            return
+
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: T.Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,69 @@
+"""
+Coordination of several bot workers sharing one mongo.
+
+Background jobs which should run on a single worker take a named lease
+(lock with expiration time). The lease is prolonged by its owner on every
+run and is taken over by another worker once the owner stops renewing it,
+so lease duration should be longer than job interval.
+"""
+
+import os
+import socket
+import datetime
+import functools
+import typing as T
+
+import pymongo.errors
+
+from . import db
+from . import asyncdb
+
+
+WORKER_ID = os.environ.get("WTB_WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+
+
+def get_leases_collection():
+    return db.get_mongo_db().leases
+
+
+def acquire_lease(name: str, duration: float) -> bool:
+    """
+    Take or prolong lease for *duration* seconds, return True on success
+    """
+    now = datetime.datetime.utcnow()
+
+    try:
+        get_leases_collection().update_one(
+            {
+                "_id": name,
+                "$or": [
+                    {"owner": WORKER_ID},
+                    {"expires_at": {"$lt": now}},
+                ],
+            },
+            {"$set": {
+                "owner": WORKER_ID,
+                "expires_at": now + datetime.timedelta(seconds=duration),
+            }},
+            upsert=True,
+        )
+    except pymongo.errors.DuplicateKeyError:  # lease is held by someone else
+        return False
+
+    return True
+
+
+def singleton(name: str, duration: float) -> T.Callable:
+    """
+    Run decorated async job only on the worker which holds lease *name*,
+    *duration* should be longer than job interval
+    """
+    def decorator(job: T.Callable[..., T.Awaitable[None]]) -> T.Callable[..., T.Awaitable[None]]:
+        @functools.wraps(job)
+        async def wrapper(*args, **kwargs) -> None:
+            if await asyncdb.run(acquire_lease, name, duration):
+                await job(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -1,30 +1,130 @@
+import os
 import datetime
+import typing as T
 
+import bson.codec_options
+import bson.raw_bson
 import pymongo
 import pymongo.database
 import pymongo.collection
+import pymongo.cursor
 
+from . import logconfig
 from . import models
-
-# TODO: add indices... someday.
-
+from . import cache
+from . import metrics
+
+logger = logconfig.logger
+
+# NOTE: indices are declared and created in migrations module
+
+
+MONGO_URL = os.environ.get("WTB_MONGO_URL", "mongodb")
+MONGO_DB_NAME = os.environ.get("WTB_MONGO_DB", "wannatalk")
+# fail fast instead of hanging for default 30 seconds when mongo is unreachable
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get("WTB_MONGO_SERVER_SELECTION_TIMEOUT_MS", "2000"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get("WTB_MONGO_CONNECT_TIMEOUT_MS", "2000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.environ.get("WTB_MONGO_SOCKET_TIMEOUT_MS", "10000"))
+# should be not less than asyncdb.DB_WORKERS, so db threads don't wait for connections
+MONGO_POOL_SIZE = int(os.environ.get("WTB_MONGO_POOL_SIZE", "20"))
+
+# only the most recent sent requests are kept in user document
+SENT_REQUESTS_LIMIT = int(os.environ.get("WTB_SENT_REQUESTS_LIMIT", "1000"))
+
+# users by user_id, filled by get_user and update_wtb_user
+USER_CACHE = cache.LRUCache(
+    maxsize=int(os.environ.get("WTB_USER_CACHE_SIZE", "10000")),
+    ttl=float(os.environ.get("WTB_USER_CACHE_TTL", "300")),
+)
+
+# unchanged users are written only to refresh last_updated once in this number of seconds
+LAST_UPDATED_INTERVAL = float(os.environ.get("WTB_LAST_UPDATED_INTERVAL", "3600"))
+
+# last_seen (any message from the user) is written at most once in this number of seconds
+LAST_SEEN_INTERVAL = float(os.environ.get("WTB_LAST_SEEN_INTERVAL", str(24 * 60 * 60)))
+
+# ids of users whose last_seen was written recently
+_SEEN_USERS = cache.LRUCache(maxsize=USER_CACHE.maxsize, ttl=LAST_SEEN_INTERVAL)
+
+# update_wtb_user calls which hit the database vs skipped as no-op
+UPDATE_COUNTERS = {
+    "written": 0,
+    "skipped": 0,
+}
+
+DB_LATENCY = metrics.Histogram(
+    "wtb_db_operation_seconds",
+    "Duration of database operations",
+    labels=("operation",),
+)
+
+metrics.Callback(
+    "wtb_user_cache_total",
+    "User cache lookups and evictions",
+    lambda: {(event,): count for event, count in USER_CACHE.get_stats().items() if event != "size"},
+    labels=("event",),
+    kind="counter",
+)
+
+metrics.Callback(
+    "wtb_user_writes_total",
+    "update_wtb_user calls which hit the database vs skipped as no-op",
+    lambda: {(result,): count for result, count in UPDATE_COUNTERS.items()},
+    labels=("result",),
+    kind="counter",
+)
+
+_MISSING = object()
+
+# other workers and the sweeper pause users (see frontend.find_pair), so
+# cached values of these fields may be stale: they are always written
+_SHARED_FIELDS = frozenset(("pause", "search_language"))
 
 _MONGO_CLIENT: pymongo.MongoClient | None = None
 
+# called with user document before and after each update_wtb_user call,
+# before is None for just created users
+_USER_LISTENERS: list[T.Callable[[dict | None, dict], None]] = []
+
 
 def get_mongo_db() -> pymongo.database.Database:
     global _MONGO_CLIENT
 
     if _MONGO_CLIENT is None:
-        _MONGO_CLIENT = pymongo.MongoClient("mongodb")
+        _MONGO_CLIENT = pymongo.MongoClient(
+            MONGO_URL,
+            serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+            connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+            socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+            maxPoolSize=MONGO_POOL_SIZE,
+        )
+
+    return _MONGO_CLIENT[MONGO_DB_NAME]
 
-    return _MONGO_CLIENT.wannatalk
+
+def _timed(wrapped):
+    return metrics.timed(DB_LATENCY, operation=wrapped.__name__)(wrapped)
 
 
 def get_users_collection() -> pymongo.collection.Collection:
     return get_mongo_db().users
 
 
+def _get_raw_users_collection() -> pymongo.collection.Collection:
+    """
+    Users collection which returns raw BSON documents, nested documents
+    are decoded only when accessed
+    """
+    return get_users_collection().with_options(
+        codec_options=bson.codec_options.CodecOptions(document_class=bson.raw_bson.RawBSONDocument),
+    )
+
+
+def add_user_listener(listener: T.Callable[[dict | None, dict], None]) -> None:
+    _USER_LISTENERS.append(listener)
+
+
+@_timed
 def count_language(lang: str) -> int:
     return get_users_collection().count_documents({
         "pause": False,
@@ -32,9 +132,20 @@ def count_language(lang: str) -> int:
     })
 
 
-def update_wtb_user(user, extra):
+def _get_changed(known: models.User, to_set: dict) -> dict:
+    """
+    Return values of *to_set* which differ from cached user
+    """
+    return {
+        key: value
+        for key, value in to_set.items()
+        if key in _SHARED_FIELDS or getattr(known, key, _MISSING) != value
+    }
+
+
+def _get_user_changes(user, extra) -> tuple[int, dict]:
     """
-    Updates user with fresh info and additionally sets extra values
+    Return user id and values to set from telegram user (or user dict) and extra values
     """
     to_set = {}
 
@@ -55,39 +166,179 @@ def update_wtb_user(user, extra):
     except AttributeError:
         user_id = user["user_id"]
 
-    # could use $currentDate, but why?
-    to_set["last_updated"] = datetime.datetime.utcnow()
-
     to_set.update(extra)
 
-    result = get_users_collection().find_one_and_update(
+    return user_id, to_set
+
+
+@_timed
+def update_wtb_user(user, extra, force: bool = False):
+    """
+    Updates user with fresh info and additionally sets extra values.
+
+    Only values which differ from cached user are written, the write is
+    skipped if nothing differs and last_updated is fresher than
+    LAST_UPDATED_INTERVAL. With *force* every value is written.
+    """
+    user_id, to_set = _get_user_changes(user, extra)
+
+    now = datetime.datetime.utcnow()
+
+    known = USER_CACHE.peek(user_id)
+    # users cached by cache_user_update don't have last_updated, their
+    # values may have not reached the database
+    if known is not None and known.last_updated is not None and not force:
+        to_set = _get_changed(known, to_set)
+        if not to_set and known.last_updated >= now - datetime.timedelta(seconds=LAST_UPDATED_INTERVAL):
+            UPDATE_COUNTERS["skipped"] += 1
+            return known
+
+    UPDATE_COUNTERS["written"] += 1
+
+    # could use $currentDate, but why?
+    to_set["last_updated"] = now
+
+    # raw documents as in get_user: sent_requests aren't decoded on every write
+    before = _get_raw_users_collection().find_one_and_update(
         {"user_id": user_id},
         {
             "$set": to_set,
             "$setOnInsert": {
                 "user_id": user_id,
                 "created_at": to_set["last_updated"],
+                "last_seen": to_set["last_updated"],
             },
         },
         upsert=True,
-        new=True,
+        return_document=pymongo.ReturnDocument.BEFORE,
+    )
+
+    if before is None:
+        # just inserted, fetch it to get _id
+        result = _get_raw_users_collection().find_one({"user_id": user_id})
+    else:
+        result = {**before, **to_set}
+
+    for listener in _USER_LISTENERS:
+        try:
+            listener(before, result)
+        except Exception:
+            logger.exception("User listener %s failed", listener)
+
+    wtb_user = models.User(**result)
+    USER_CACHE.set(user_id, wtb_user)
+
+    return wtb_user
+
+
+def is_seen_recently(user_id: int) -> bool:
+    return _SEEN_USERS.peek(user_id) is not None
+
+
+@_timed
+def touch_user(user_id: int) -> None:
+    """
+    Record that user is active, see get_inactive_users
+    """
+    get_users_collection().update_one(
+        {"user_id": user_id},
+        {"$set": {"last_seen": datetime.datetime.utcnow()}},
+    )
+    _SEEN_USERS.set(user_id, True)
+
+
+def _make_request(to_user_id: int, language: str) -> dict:
+    return {
+        "user_id": to_user_id,
+        "language": language,
+        "created_at": datetime.datetime.utcnow(),
+    }
+
+
+def _cache_sent_request(user_id: int, request: dict, stale: bool = False) -> None:
+    # apply the same change to cached user instead of fetching it again
+    wtb_user = USER_CACHE.peek(user_id, stale=stale)
+    if wtb_user is not None:
+        sent_requests = (wtb_user.sent_requests + [request])[-SENT_REQUESTS_LIMIT:]
+        USER_CACHE.set(user_id, wtb_user.replace(sent_requests=sent_requests))
+
+
+@_timed
+def add_sent_request(user_id: int, to_user_id: int, language: str) -> None:
+    """
+    Atomically append request to user's sent_requests keeping only last SENT_REQUESTS_LIMIT
+    """
+    request = _make_request(to_user_id, language)
+
+    get_users_collection().update_one(
+        {"user_id": user_id},
+        {"$push": {"sent_requests": {
+            "$each": [request],
+            "$slice": -SENT_REQUESTS_LIMIT,
+        }}},
     )
 
-    return models.User(**result)
+    _cache_sent_request(user_id, request)
+
+
+def cache_user_update(user, extra) -> models.User:
+    """
+    Apply update_wtb_user changes to cached user only, used while database
+    is unavailable and the write is postponed
+    """
+    user_id, to_set = _get_user_changes(user, extra)
+
+    known = USER_CACHE.peek(user_id, stale=True)
+    if known is None:
+        wtb_user = models.User(user_id=user_id, **to_set)
+    else:
+        wtb_user = known.replace(**to_set)
+
+    USER_CACHE.set(user_id, wtb_user)
+    return wtb_user
+
+
+def cache_sent_request(user_id: int, to_user_id: int, language: str) -> None:
+    """
+    Apply add_sent_request to cached user only, see cache_user_update
+    """
+    _cache_sent_request(user_id, _make_request(to_user_id, language), stale=True)
 
 
 def get_messages_collection() -> pymongo.collection.Collection:
     return get_mongo_db().messages
 
 
-def get_user(user_id: int) -> models.User | None:
-    db_user = get_users_collection().find_one({"user_id": user_id})
-    if db_user:
-        return models.User(**db_user)
+def get_meta_collection() -> pymongo.collection.Collection:
+    """
+    Service documents: schema version, published stats, etc
+    """
+    return get_mongo_db().meta
 
-    return None
 
+@_timed
+def get_user(user_id: int, fields: T.Iterable[str] | None = None) -> models.User | None:
+    """
+    Return cached or fetch user. If *fields* are given only they are fetched
+    (the rest get default values) and the user isn't cached.
+    """
+    wtb_user = USER_CACHE.get(user_id)
+    if wtb_user is not None:
+        return wtb_user
 
+    projection = dict.fromkeys(fields, True) if fields is not None else None
+    db_user = _get_raw_users_collection().find_one({"user_id": user_id}, projection)
+    if db_user is None:
+        return None
+
+    wtb_user = models.User(**db_user)
+    if projection is None:
+        USER_CACHE.set(user_id, wtb_user)
+
+    return wtb_user
+
+
+@_timed
 def get_pair(skip_users: list[int], language: str) -> dict | None:
     pipeline = [
         {
@@ -106,49 +357,121 @@ def get_pair(skip_users: list[int], language: str) -> dict | None:
     return sample[0] if sample else None
 
 
-def get_user_count() -> int:
-    return get_users_collection().count_documents({})
-
+@_timed
+def get_reciprocal_pair(skip_users: list[int], language: str, search_language: str) -> dict | None:
+    """
+    Same as get_pair, but the user should also want to practice *search_language*
+    """
+    pipeline = [
+        {
+            "$match": {
+                "pause": False,
+                "language": language,
+                "search_language": search_language,
+                "user_id": {
+                    "$nin": skip_users,
+                },
+            },
+        },
+        {"$sample": {"size": 1}},
+    ]
+    sample = list(get_users_collection().aggregate(pipeline))
 
-def get_active_user_count() -> int:
-    return get_users_collection().count_documents({"pause": {"$ne": True}})
+    return sample[0] if sample else None
 
 
-def get_recent_user_count(days) -> int:
-    return get_users_collection().count_documents(
-        {"created_at": {"$gte": datetime.datetime.utcnow() - datetime.timedelta(days=days)}},
+def get_active_users() -> pymongo.cursor.Cursor:
+    """
+    Return users who could be picked by get_pair
+    """
+    return get_users_collection().find(
+        {"pause": False},
+        {"_id": False, "user_id": True, "language": True, "search_language": True, "pause": True},
     )
 
 
-def get_top_wanted_languages(limit: int):
-    return get_users_collection().aggregate([
-        {"$match": {"search_language": {"$ne": None}}},
-        {"$sortByCount": "$search_language"},
-        {"$limit": limit},
-    ])
+@_timed
+def get_active_user_ids(
+        after_user_id: int,
+        limit: int,
+        seen_before: datetime.datetime | None = None,
+) -> list[int]:
+    """
+    Return ids of active users greater than *after_user_id* in ascending
+    order, optionally only those who weren't seen since *seen_before*
+    """
+    query = {"pause": False, "user_id": {"$gt": after_user_id}}
+    if seen_before is not None:
+        query["last_seen"] = {"$lt": seen_before}
 
+    cursor = get_users_collection().find(
+        query,
+        {"_id": False, "user_id": True},
+    ).sort("user_id", pymongo.ASCENDING).limit(limit)
+
+    return [u["user_id"] for u in cursor]
+
+
+@_timed
+def get_inactive_users(days: float, limit: int) -> list[dict]:
+    """
+    Return active users who haven't sent anything to the bot within *days*
+    """
+    cursor = get_users_collection().find(
+        {
+            "pause": False,
+            "last_seen": {"$lt": datetime.datetime.utcnow() - datetime.timedelta(days=days)},
+        },
+        {"_id": False, "user_id": True},
+    ).limit(limit)
+
+    return list(cursor)
 
-def get_top_known_languages(limit: int):
-    return get_users_collection().aggregate([
-        {"$match": {"language": {"$ne": None}}},
-        {"$sortByCount": "$language"},
-        {"$limit": limit},
-    ])
 
+@_timed
+def get_notify_recipients(language: str, after_user_id: int, limit: int) -> list[int]:
+    """
+    Return ids of active users greater than *after_user_id* who search
+    *language* and want to be notified, in ascending order
+    """
+    cursor = get_users_collection().find(
+        {
+            "search_language": language,
+            "notify": True,
+            "pause": False,
+            "user_id": {"$gt": after_user_id},
+        },
+        {"_id": False, "user_id": True},
+    ).sort("user_id", pymongo.ASCENDING).limit(limit)
 
-def get_top_language_pairs(limit: int):
+    return [u["user_id"] for u in cursor]
+
+
+def get_language_groups():
+    """
+    Count users grouped by language, search language and pause flag
+    """
     return get_users_collection().aggregate([
-        {"$match": {"$and": [
-            {"language": {"$ne": None}},
-            {"search_language": {"$ne": None}},
-        ]}},
-        {"$project": {"langs": ["$search_language", "$language"]}},
-        {"$unwind": "$langs"},
-        {"$sort": {"langs": 1}},
         {"$group": {
-            "_id": '$_id',
-            "langs": {"$push": "$langs"},
+            "_id": {
+                "language": "$language",
+                "search_language": "$search_language",
+                "pause": "$pause",
+            },
+            "count": {"$sum": 1},
         }},
-        {"$sortByCount": "$langs"},
-        {"$limit": limit},
     ])
+
+
+@_timed
+def get_daily_user_counts(since: datetime.datetime) -> list[dict]:
+    """
+    Count users created since *since* grouped by day ("YYYY-MM-DD" in _id)
+    """
+    return list(get_users_collection().aggregate([
+        {"$match": {"created_at": {"$gte": since}}},
+        {"$group": {
+            "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
+            "count": {"$sum": 1},
+        }},
+    ]))
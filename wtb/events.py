@@ -0,0 +1,116 @@
+"""
+Telemetry events.
+
+Compact typed records of what users do: pairing attempts and results,
+blocked users, language changes. Events are written in background by
+EVENT_WRITER in batches and expire after EVENTS_TTL_DAYS (see TTL index
+in migrations.INDEXES).
+
+Use funnel and count_events for analytics instead of scanning messages.
+"""
+
+import os
+import datetime
+
+import pymongo.collection
+
+from . import db
+from . import batchwriter
+
+PAIR_ATTEMPT = "pair_attempt"
+PAIR_SENT = "pair_sent"
+PAIR_NOT_FOUND = "pair_not_found"
+USER_BLOCKED = "user_blocked"
+LANGUAGE_SET = "language_set"
+SEARCH_LANGUAGE_SET = "search_language_set"
+
+EVENT_TYPES = frozenset([
+    PAIR_ATTEMPT,
+    PAIR_SENT,
+    PAIR_NOT_FOUND,
+    USER_BLOCKED,
+    LANGUAGE_SET,
+    SEARCH_LANGUAGE_SET,
+])
+
+EVENTS_TTL_DAYS = int(os.environ.get("WTB_EVENTS_TTL_DAYS", "90"))
+
+
+def get_events_collection() -> pymongo.collection.Collection:
+    return db.get_mongo_db().events
+
+
+EVENT_WRITER = batchwriter.BatchWriter(
+    "events",
+    get_events_collection,
+    max_queue_size=int(os.environ.get("WTB_EVENTS_QUEUE_SIZE", "10000")),
+)
+
+
+async def emit(event_type: str, user_id: int, **data) -> None:
+    """
+    Queue event of *event_type* made by *user_id*, data should be small
+    """
+    if event_type not in EVENT_TYPES:
+        raise ValueError(f"Unknown event type: {event_type}")
+
+    await EVENT_WRITER.put({
+        "type": event_type,
+        "user_id": user_id,
+        "date": datetime.datetime.utcnow(),
+        **data,
+    })
+
+
+def _get_period_match(
+        event_types: list[str],
+        since: datetime.datetime,
+        until: datetime.datetime | None,
+) -> dict:
+    date = {"$gte": since}
+    if until is not None:
+        date["$lt"] = until
+
+    return {"$match": {"type": {"$in": list(event_types)}, "date": date}}
+
+
+def funnel(
+        steps: list[str],
+        since: datetime.datetime,
+        until: datetime.datetime | None = None,
+) -> list[tuple[str, int]]:
+    """
+    Count distinct users per funnel step within the period. A user is
+    counted on a step if they made events of this and all previous steps,
+    e.g. funnel([PAIR_ATTEMPT, PAIR_SENT], since) -> [(PAIR_ATTEMPT, 120), (PAIR_SENT, 95)]
+    """
+    result = list(get_events_collection().aggregate([
+        _get_period_match(steps, since, until),
+        {"$group": {"_id": "$user_id", "types": {"$addToSet": "$type"}}},
+        {"$group": {
+            "_id": None,
+            **{
+                f"step{i}": {"$sum": {"$cond": [{"$setIsSubset": [steps[:i + 1], "$types"]}, 1, 0]}}
+                for i in range(len(steps))
+            },
+        }},
+    ]))
+
+    counts = result[0] if result else {}
+    return [(step, counts.get(f"step{i}", 0)) for i, step in enumerate(steps)]
+
+
+def count_events(
+        since: datetime.datetime,
+        until: datetime.datetime | None = None,
+        event_types: list[str] | None = None,
+) -> dict[str, int]:
+    """
+    Count events by type within the period
+    """
+    cursor = get_events_collection().aggregate([
+        _get_period_match(event_types or sorted(EVENT_TYPES), since, until),
+        {"$group": {"_id": "$type", "count": {"$sum": 1}}},
+    ])
+
+    return {doc["_id"]: doc["count"] for doc in cursor}
@@ -5,8 +5,8 @@ Bot's facade. Part which is responsible for initial user conversation.
 """
 
 import typing
-import datetime
 
+import pymongo.errors
 import telegram
 from telegram import (
     ReplyKeyboardMarkup,
@@ -18,10 +18,18 @@ from telegram.ext import MessageHandler
 from telegram.ext import ConversationHandler
 
 from . import logconfig
-from . import db
+from . import asyncdb
 from . import models
 from . import langsdb
 from . import botutils
+from . import migrations
+from . import usagestats
+from . import matchpool
+from . import ratelimit
+from . import outbox
+from . import metrics
+from . import events
+from . import sweeper
 
 
 logger = logconfig.logger
@@ -34,6 +42,16 @@ SET_NATIVE_LANGUAGE_STATE = "SET_NATIVE_LANGUAGE_STATE"
 SEARCH_LANGUAGE_STATE = "SEARCH_LANGUAGE_STATE"
 FIND_STATE = "FIND"
 STATS = "/stats"
+NOTIFY = "/notify"
+
+# user fields which are needed to build actions keyboard
+KEYBOARD_FIELDS = ("user_id", "language", "search_language")
+
+PAIRING_RESULTS = metrics.Counter(
+    "wtb_pairing_total",
+    "Pairing attempts by result",
+    labels=("result",),
+)
 
 
 class TextCommands:
@@ -69,20 +87,25 @@ def get_actions_keyboard(wtb_user: typing.Optional[models.User]):
     )
 
 
-def get_wtb_user_from_update(update: telegram.Update) -> models.User | None:
-    return db.get_user(update.message.from_user.id)
+async def get_wtb_user_from_update(
+        update: telegram.Update,
+        fields: typing.Iterable[str] | None = None,
+) -> models.User | None:
+    return await asyncdb.get_user(update.message.from_user.id, fields)
 
 
+@botutils.track_latency
 @botutils.log_message
 async def default_handler(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Find user in DB.
     If it's missing ask him to enter his language.
     """
-    wtb_user = get_wtb_user_from_update(update)
+    wtb_user = await get_wtb_user_from_update(update, KEYBOARD_FIELDS)
 
     if wtb_user is None:
-        await update.message.reply_markdown(
+        await outbox.OUTBOX.reply(
+            update.message,
             (
                 "Hello, this is WannaTalkBot!"
                 "\n\n"
@@ -95,6 +118,9 @@ async def default_handler(update: telegram.Update, context: ContextTypes.DEFAULT
                 "\n\n"
                 "You can get some bot usage stats with /stats command."
                 "\n\n"
+                "Use /notify command to get a message when a native speaker of "
+                "the language you search joins."
+                "\n\n"
                 "P.S. This project is in it's early stage, so there are not too "
                 "much users and not too much features. Also some bugs are "
                 "possible."
@@ -104,7 +130,8 @@ async def default_handler(update: telegram.Update, context: ContextTypes.DEFAULT
         return
 
     lang = wtb_user.language
-    await update.message.reply_markdown(
+    await outbox.OUTBOX.reply(
+        update.message,
         (
             f"Your native language is currently set to {lang}."
             f"\n\n"
@@ -115,13 +142,17 @@ async def default_handler(update: telegram.Update, context: ContextTypes.DEFAULT
     )
 
 
+@botutils.track_latency
+@ratelimit.limit("stats", burst=3, period=30)
 async def stats(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
-    Print usage statistics.
+    Print usage statistics. Served from memory, see usagestats module.
     """
-    wtb_user = get_wtb_user_from_update(update)
+    wtb_user = await get_wtb_user_from_update(update, KEYBOARD_FIELDS)
+    snapshot = usagestats.USAGE_STATS.snapshot()
 
-    await update.message.reply_markdown(
+    await outbox.OUTBOX.reply(
+        update.message,
         (
             "Total users: {}\n"
             "Active users: {}\n"
@@ -136,35 +167,66 @@ async def stats(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) ->
             "Top 5 most popular language pairs:\n"
             "{}\n"
         ).format(
-            db.get_user_count(),
-            db.get_active_user_count(),
-            db.get_recent_user_count(30),
-            "\n".join(f"{i['_id']}: {i['count']}" for i in db.get_top_wanted_languages(5)),
-            "\n".join(f"{i['_id']}: {i['count']}" for i in db.get_top_known_languages(5)),
-            "\n".join(', '.join(i['_id']) + ': ' + str(i['count']) for i in db.get_top_language_pairs(5)),
+            snapshot["total"],
+            snapshot["active"],
+            snapshot["recent"],
+            "\n".join(f"{lang}: {count}" for lang, count in snapshot["top_wanted"]),
+            "\n".join(f"{lang}: {count}" for lang, count in snapshot["top_known"]),
+            "\n".join(', '.join(pair) + ': ' + str(count) for pair, count in snapshot["top_pairs"]),
         ),
         reply_markup=get_actions_keyboard(wtb_user),
     )
 
 
+@botutils.track_latency
+@botutils.log_message
+async def toggle_notifications(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Turn notifications about new native speakers of search language on or off
+    """
+    wtb_user = await get_wtb_user_from_update(update, (*KEYBOARD_FIELDS, "notify"))
+
+    if wtb_user is None or not wtb_user.search_language:
+        await outbox.OUTBOX.reply(
+            update.message,
+            "Set language which you want to practice first.",
+            reply_markup=get_actions_keyboard(wtb_user),
+        )
+        return
+
+    notify = not wtb_user.notify
+    wtb_user = await asyncdb.update_wtb_user(update.message.from_user, {"notify": notify})
+
+    if notify:
+        text = f"You will get a message when a native speaker of {wtb_user.search_language} joins."
+    else:
+        text = "Notifications about new native speakers are turned off."
+
+    await outbox.OUTBOX.reply(update.message, text, reply_markup=get_actions_keyboard(wtb_user))
+
+
 def get_lang_from_udpate(update):
     return langsdb.guess_lang(update.message.text.strip(), full=True)
 
 
+@botutils.track_latency
 @botutils.log_message
 async def set_native_language(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> int | str:
     if update.message.text and not update.message.text.startswith(TextCommands.SET_NATIVE_LANGUAGE):
         lang = get_lang_from_udpate(update)
 
         if lang:
-            wtb_user = db.update_wtb_user(update.message.from_user, {"language": lang})
-            await update.message.reply_markdown(
+            wtb_user = await asyncdb.update_wtb_user(update.message.from_user, {"language": lang})
+            await events.emit(events.LANGUAGE_SET, wtb_user.user_id, language=lang)
+            await outbox.OUTBOX.reply(
+                update.message,
                 f"Your native language is set to {lang}.",
                 reply_markup=get_actions_keyboard(wtb_user),
             )
             return ConversationHandler.END
         else:
-            await update.message.reply_markdown(
+            await outbox.OUTBOX.reply(
+                update.message,
                 (
                     "Sorry, failed to recognize language. Maybe you'd misspelled it?"
                     "\n\n"
@@ -174,7 +236,8 @@ async def set_native_language(update: telegram.Update, context: ContextTypes.DEF
             )
             return SET_NATIVE_LANGUAGE_STATE
 
-    await update.message.reply_markdown(
+    await outbox.OUTBOX.reply(
+        update.message,
         (
             "Specify your native language. People who "
             "want to practice it would be able to send you requests to talk."
@@ -188,13 +251,15 @@ async def set_native_language(update: telegram.Update, context: ContextTypes.DEF
     return SET_NATIVE_LANGUAGE_STATE
 
 
+@botutils.track_latency
 @botutils.log_message
 async def search_language(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> int | str:
     """
     Search users with specified language and send them request to talk
     """
     if not update.message.text or update.message.text.startswith(TextCommands.SEARCH_LANGUAGE):
-        await update.message.reply_markdown(
+        await outbox.OUTBOX.reply(
+            update.message,
             (
                 "Specify language which you want to practice (in English, 2 or 3 "
                 "letters or full name):"
@@ -205,16 +270,21 @@ async def search_language(update: telegram.Update, context: ContextTypes.DEFAULT
 
     lang = get_lang_from_udpate(update)
     if lang:
-        wtb_user = db.update_wtb_user(
+        wtb_user = await asyncdb.update_wtb_user(
             update.message.from_user,
             {
                 "search_language": lang,
                 "pause": False,
             }
         )
-        counter = db.count_language(lang)
+        await events.emit(events.SEARCH_LANGUAGE_SET, wtb_user.user_id, search_language=lang)
+        if matchpool.MATCH_POOL.ready:
+            counter = matchpool.MATCH_POOL.count(lang)
+        else:
+            counter = await asyncdb.count_language(lang)
 
-        await update.message.reply_markdown(
+        await outbox.OUTBOX.reply(
+            update.message,
             (
                 "Right now we have {language_counter}"
                 " active users who specified {language} as their native "
@@ -233,7 +303,8 @@ async def search_language(update: telegram.Update, context: ContextTypes.DEFAULT
         )
         return ConversationHandler.END
 
-    await update.message.reply_markdown(
+    await outbox.OUTBOX.reply(
+        update.message,
         (
             "Sorry, failed to recognize language. Maybe you'd misspelled it?"
             "\n\n"
@@ -244,39 +315,37 @@ async def search_language(update: telegram.Update, context: ContextTypes.DEFAULT
     return SEARCH_LANGUAGE_STATE
 
 
+@botutils.track_latency
 @botutils.log_message
+@ratelimit.limit("find", burst=3, period=60)
 async def find_pair(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Find user to practice language with.
-
-    TODO: limit requests frequency rate
     """
 
-    wtb_user = get_wtb_user_from_update(update)
+    wtb_user = await get_wtb_user_from_update(update)
 
-    # should be rather a telemetry event, but we don't have telemetry events :)
-    logger.info(
-        "User %s is trying to pair: %s -> %s",
+    await events.emit(
+        events.PAIR_ATTEMPT,
         wtb_user.user_id,
-        wtb_user.language,
-        wtb_user.search_language,
+        language=wtb_user.language,
+        search_language=wtb_user.search_language,
     )
 
-    skip_users = [wtb_user.user_id]
-    skip_users.extend(
-        r["user_id"]
-        for r in wtb_user.sent_requests
-        if r["language"] == wtb_user.search_language
-    )
+    skip_users = wtb_user.get_contacted_users(wtb_user.search_language)
+    skip_users.add(wtb_user.user_id)
 
     attempts = PAIR_ATTEMPTS
     while attempts > 0:
         attempts -= 1
 
-        pair = db.get_pair(skip_users, wtb_user.search_language)
+        pair = await matchpool.get_pair(skip_users, wtb_user.search_language, wtb_user.language)
 
         if not pair:
-            await update.message.reply_markdown(
+            PAIRING_RESULTS.inc(result="not_found")
+            await events.emit(events.PAIR_NOT_FOUND, wtb_user.user_id, search_language=wtb_user.search_language)
+            await outbox.OUTBOX.reply(
+                update.message,
                 (
                     "Unfortunately we can't find anyone right now. Please, "
                     "try later."
@@ -287,7 +356,8 @@ async def find_pair(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE)
 
         try:
             # NOTE: tagging a user could not work depending on user's privacy settings
-            await context.bot.send_message(
+            await outbox.OUTBOX.send(
+                priority=outbox.PRIORITY_HIGH,
                 text=(
                     r"Hey\! Someone needs your help\. Just drop a message to "
                     r"[{name}](tg://user?id={user_id}) in {language} when it's "
@@ -302,19 +372,24 @@ async def find_pair(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE)
                 chat_id=pair["user_id"],
             )
         except telegram.error.Forbidden:  # bot is blocked by user
-            db.update_wtb_user(pair, {"pause": True})
+            PAIRING_RESULTS.inc(result="blocked")
+            await events.emit(events.USER_BLOCKED, pair["user_id"])
+            skip_users.add(pair["user_id"])
+            await asyncdb.update_wtb_user(pair, {"pause": True})
             continue
 
-        # FIXME: overriding whole list of requests is inefficient
-        sent_requests = wtb_user.sent_requests
-        sent_requests.append({
-            "user_id": pair["user_id"],
-            "language": wtb_user.search_language,
-            "created_at": datetime.datetime.utcnow(),
-        })
-        db.update_wtb_user(wtb_user, {"sent_requests": sent_requests})
+        PAIRING_RESULTS.inc(result="sent")
+        await events.emit(
+            events.PAIR_SENT,
+            wtb_user.user_id,
+            to_user_id=pair["user_id"],
+            search_language=wtb_user.search_language,
+            reciprocal=pair.get("reciprocal", False),
+        )
+        await asyncdb.add_sent_request(wtb_user.user_id, pair["user_id"], wtb_user.search_language)
 
-        await update.message.reply_markdown(
+        await outbox.OUTBOX.reply(
+            update.message,
             (
                 "We have found someone and sent your contacts. Just wait "
                 "for \\*hello\\* from this user."
@@ -324,8 +399,6 @@ async def find_pair(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE)
             reply_markup=get_actions_keyboard(wtb_user),
         )
 
-        logger.info("%s sent request to %s", wtb_user.user_id, pair["user_id"])
-
         break
 
 
@@ -339,24 +412,62 @@ def get_user_display_name(wtb_user: models.User) -> str:
     return name.strip() or "no_name"
 
 
+@botutils.track_latency
 @botutils.log_message
 async def fallback_command(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.error("Caught fallback on update: %s", update)
-    await update.message.reply_markdown(
+    await outbox.OUTBOX.reply(
+        update.message,
         "Something went wrong, can't handle your request."
     )
 
 
 async def log_error(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log Errors caused by Updates"""
+    if isinstance(context.error, (asyncdb.DatabaseUnavailable, pymongo.errors.ConnectionFailure)):
+        # handler needed the database in degraded mode, tell the user instead of silence
+        logger.warning('Update "%s" failed, database is unavailable', update)
+        if isinstance(update, telegram.Update) and update.message:
+            await outbox.OUTBOX.reply(
+                update.message,
+                "Sorry, the bot is temporarily unavailable. Please, try again in a few minutes."
+            )
+        return
+
     logger.error('Update "%s" caused error "%s"', update, context.error, exc_info=True)
 
 
 def main() -> None:
     logger.info("Starting WannaTalkBot...")
 
+    migrations.migrate()
+    usagestats.USAGE_STATS.reconcile()
+    matchpool.MATCH_POOL.warm()
+
     app = botutils.get_application()
 
+    app.job_queue.run_repeating(
+        usagestats.reconcile_job,
+        interval=usagestats.RECONCILE_INTERVAL,
+        first=usagestats.RECONCILE_INTERVAL,
+    )
+    app.job_queue.run_repeating(
+        matchpool.warm_job,
+        interval=matchpool.REFRESH_INTERVAL,
+        first=matchpool.REFRESH_INTERVAL,
+    )
+    app.job_queue.run_repeating(
+        sweeper.sweep_job,
+        interval=sweeper.SWEEP_INTERVAL,
+        first=sweeper.SWEEP_INTERVAL,
+    )
+
+    add_handlers(app)
+
+    botutils.run_application(app)
+
+
+def add_handlers(app: telegram.ext.Application) -> None:
     handler = ConversationHandler(
         entry_points=[
             MessageHandler(
@@ -374,6 +485,9 @@ def main() -> None:
         fallbacks=[
             MessageHandler(filters.ALL, fallback_command),
         ],
+
+        name="set_native_language",
+        persistent=True,
     )
     app.add_handler(handler)
 
@@ -394,6 +508,9 @@ def main() -> None:
         fallbacks=[
             MessageHandler(filters.ALL, fallback_command),
         ],
+
+        name="search_language",
+        persistent=True,
     )
     app.add_handler(handler)
 
@@ -414,6 +531,9 @@ def main() -> None:
         fallbacks=[
             MessageHandler(filters.ALL, fallback_command),
         ],
+
+        name="find",
+        persistent=True,
     )
     app.add_handler(handler)
 
@@ -429,13 +549,14 @@ def main() -> None:
     )
     app.add_handler(handler)
 
+    handler = MessageHandler(
+        filters.Text([NOTIFY]),
+        toggle_notifications,
+    )
+    app.add_handler(handler)
+
     handler = MessageHandler(filters.ALL, default_handler)
     app.add_handler(handler)
 
     # log all errors
     app.add_error_handler(log_error)
-
-    # Run the bot until you press Ctrl-C or the process receives SIGINT,
-    # SIGTERM or SIGABRT. This should be used most of the time, since
-    # start_polling() is non-blocking and will stop the bot gracefully.
-    app.run_polling()
@@ -8,7 +8,10 @@ Works with the following standarts:
 TODO: add ISO 639-2/T support in gues_lang function with lowest priority?
 """
 
+import functools
+import hashlib
 import logging
+import marshal
 import os
 
 
@@ -16,6 +19,7 @@ logger = logging.getLogger(__name__)
 
 _SHORT_LANGS = None
 _LONG_LANGS = None
+_INDEX = None
 
 
 LANGS_PATH = os.path.join(
@@ -23,26 +27,215 @@ LANGS_PATH = os.path.join(
     "language-codes.csv",
 )
 
+# Lookup tables compiled from LANGS_PATH which is the source of truth.
+# Artifact is rebuilt automatically when CSV checksum or ARTIFACT_VERSION
+# (bump it on any change of tables format) doesn't match.
+ARTIFACT_PATH = os.path.join(
+    os.path.abspath(__file__).rsplit(os.path.sep, 1)[0],
+    "language-codes.marshal",
+)
+ARTIFACT_VERSION = 3
+
 
 def guess_lang(maybe_lang, full=False):
-    """Returns short code for given *maybe lang* or None"""
+    """
+    Returns short code (or long name if *full*) for given *maybe lang* or None.
+
+    Lookup order:
+        1. exact match of a code or any of language names
+        2. substring of a name, see _partial_rank for ambiguity resolution
+        3. name with typos, see MAX_TYPOS and _guess_misspelled_lang
+    """
     if len(maybe_lang) < 2:
         return None
 
     maybe_lang = maybe_lang.lower()
+    index = get_index()
+
+    if maybe_lang in index["codes"]:
+        code, long_ = maybe_lang, index["codes"][maybe_lang]
+    elif maybe_lang in index["partial"]:
+        code, long_ = index["langs"][index["partial"][maybe_lang]]
+    else:
+        match = _guess_misspelled_lang(maybe_lang)
+        if match is None:
+            return None
+        code, long_ = match
+
+    return long_ if full else code
+
+
+# max allowed number of typos depending on input length, shorter inputs
+# are too ambiguous to be corrected
+MAX_TYPOS = (
+    (4, 0),
+    (7, 1),
+    (None, 2),
+)
+
+
+def _max_typos(length):
+    for max_length, typos in MAX_TYPOS:
+        if max_length is None or length < max_length:
+            return typos
+
+
+def _partial_rank(substring, name, is_main, main_long):
+    """
+    Ranking of languages which names contain the same substring, lower
+    is better:
+        * name starts with substring
+        * name is the main name of the language, not an alternative one
+        * shorter name, i.e. bigger part of the name was entered
+        * main name in alphabetical order
+    """
+    return (not name.startswith(substring), not is_main, len(name), main_long)
+
+
+def _get_deletes(word, max_deletes):
+    """
+    Return strings which are *word* with up to *max_deletes* letters deleted
+    """
+    deletes = {word}
+    frontier = {word}
+
+    for _ in range(max_deletes):
+        frontier = {w[:i] + w[i + 1:] for w in frontier for i in range(len(w))}
+        deletes |= frontier
+
+    return deletes
+
+
+def _typo_distance(a, b, bound):
+    """
+    Optimal string alignment distance (Levenshtein with transpositions),
+    returns bound + 1 if distance exceeds bound.
+    """
+    if abs(len(a) - len(b)) > bound:
+        return bound + 1
+
+    prev2 = None
+    prev = list(range(len(b) + 1))
+
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                cur[j] = min(cur[j], prev2[j - 2] + 1)
+
+        if min(cur) > bound:
+            return bound + 1
+
+        prev2, prev = prev, cur
+
+    return prev[-1]
+
+
+@functools.lru_cache(maxsize=1024)
+def _guess_misspelled_lang(maybe_lang):
+    """
+    Names within the distance share a string with *maybe_lang* when up to
+    the distance letters are deleted from both (symmetric delete), so only
+    such candidates are compared
+    """
+    bound = _max_typos(len(maybe_lang))
+    if not bound:
+        return None
+
+    index = get_index()
+    candidates = set()
+    for deleted in _get_deletes(maybe_lang, bound):
+        candidates.update(index["typos"].get(deleted, ()))
+
+    best = None
+    for position in sorted(candidates):
+        name, is_main, code, main_long = index["names"][position]
+        distance = _typo_distance(maybe_lang, name, bound)
+        if distance > bound:
+            continue
+
+        rank = (distance, not is_main, main_long)
+        if best is None or rank < best[0]:
+            best = (rank, code, main_long)
 
-    short_langs = get_long_langs()
+    if best is None:
+        return None
+
+    logger.debug("%s looks like %s", maybe_lang, best[2])
+    return best[1], best[2]
+
+
+def get_index():
+    """
+    Return lookup index:
+        codes: <2 or 3 letters code>: <long lang name>
+        langs: [(<code>, <long lang name>)]
+        partial: <any substring of any lang name in lower case>: <position in langs>
+        names: [(<lang name in lower case>, <is main name>, <code>, <long lang name>)]
+        typos: <name with up to max of MAX_TYPOS letters deleted>: [<position in names>]
+
+    Partial is the flattened prefix trie of all name suffixes, so a lookup
+    by prefix or substring is a single dict access. Exact names are
+    substrings too and always win by _partial_rank.
+    """
+    if _INDEX is None:
+        _load()
+
+    return _INDEX
+
+
+def _build_index():
+    codes = {}
+    langs = []
+    names = []
+    ranks = {}
+    partial = {}
+    typos = {}
+    max_deletes = max(typos for _, typos in MAX_TYPOS)
 
-    if maybe_lang in short_langs:
-        return short_langs[maybe_lang] if full else maybe_lang
+    for short_3, short_2, longs in _read_langs():
+        main_long = longs[0]
+        langs.append((short_3, main_long))
 
-    for key, value in short_langs.items():
-        logger.debug("comparing %s vs %s", maybe_lang, value)
-        if maybe_lang in value.lower():
-            logger.debug("%s looks like %s", maybe_lang, value)
-            return value if full else key
+        for code in (short_3, short_2):
+            if code:
+                codes[code] = main_long
 
-    return None
+        for i, long_ in enumerate(longs):
+            name = long_.lower()
+            names.append((name, i == 0, short_3, main_long))
+
+            for deleted in _get_deletes(name, max_deletes):
+                typos.setdefault(deleted, []).append(len(names) - 1)
+
+            for start in range(len(name)):
+                for stop in range(start + 2, len(name) + 1):
+                    substring = name[start:stop]
+                    rank = _partial_rank(substring, name, i == 0, main_long)
+                    if substring not in ranks or rank < ranks[substring]:
+                        ranks[substring] = rank
+                        partial[substring] = len(langs) - 1
+
+    return {
+        "codes": codes,
+        "langs": langs,
+        "partial": partial,
+        "names": names,
+        "typos": typos,
+    }
+
+
+def _read_langs():
+    """
+    Yield (<3 letters code>, <2 letters code or empty string>, [<long names>])
+    """
+    with open(LANGS_PATH) as in_:
+        for line in in_:
+            short_3, short_2, longs = line.split(',', 2)
+            longs = longs.replace('"', '')
+            yield short_3, short_2, [long_.strip() for long_ in longs.split(";")]
 
 
 def get_long_langs():
@@ -50,26 +243,90 @@ def get_long_langs():
     Return the following dict:
         <short or long lang name in lower case>: <long lang name>
     """
-    global _LONG_LANGS
-
     if _LONG_LANGS is None:
-        langs = {}
+        _load()
 
-        with open(LANGS_PATH) as in_:
-            for line in in_:
-                short_2, short_3, longs = line.split(',', 2)
+    return _LONG_LANGS
 
-                longs = longs.replace('"', '')
-                main_long = longs.split(";", 1)[0].strip()
 
-                langs[short_2] = langs[short_3] = main_long
-                for long_ in longs.split(";"):
-                    langs[long_.strip().lower()] = main_long
+def _build_long_langs():
+    langs = {}
 
-        _LONG_LANGS = langs
+    for short_3, short_2, longs in _read_langs():
+        main_long = longs[0]
 
-    return _LONG_LANGS
+        langs[short_3] = langs[short_2] = main_long
+        for long_ in longs:
+            langs[long_.lower()] = main_long
+
+    return langs
+
+
+def _get_checksum():
+    with open(LANGS_PATH, "rb") as in_:
+        return hashlib.blake2b(in_.read(), digest_size=16).hexdigest()
+
+
+def compile_artifact():
+    """
+    Build lookup tables from CSV and store them to ARTIFACT_PATH
+    """
+    artifact = {
+        "version": ARTIFACT_VERSION,
+        "checksum": _get_checksum(),
+        "long_langs": _build_long_langs(),
+        "index": _build_index(),
+    }
+
+    # write to temporary file first, so concurrent readers never see partial artifact
+    tmp_path = f"{ARTIFACT_PATH}.{os.getpid()}"
+    with open(tmp_path, "wb") as out:
+        marshal.dump(artifact, out)
+    os.replace(tmp_path, ARTIFACT_PATH)
+
+    return artifact
+
+
+def _load_artifact():
+    try:
+        with open(ARTIFACT_PATH, "rb") as in_:
+            artifact = marshal.loads(in_.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+    if (
+        not isinstance(artifact, dict)
+        or artifact.get("version") != ARTIFACT_VERSION
+        or artifact.get("checksum") != _get_checksum()
+    ):
+        return None
+
+    return artifact
+
+
+def _load():
+    global _LONG_LANGS, _INDEX
+
+    artifact = _load_artifact()
+
+    if artifact is None:
+        logger.info("Language artifact is missing or outdated, compiling it from %s", LANGS_PATH)
+        try:
+            artifact = compile_artifact()
+        except OSError:
+            # e.g. read-only installation, just use tables built in memory
+            logger.warning("Failed to store language artifact to %s", ARTIFACT_PATH, exc_info=True)
+            artifact = {
+                "long_langs": _build_long_langs(),
+                "index": _build_index(),
+            }
+
+    _LONG_LANGS = artifact["long_langs"]
+    _INDEX = artifact["index"]
 
 
-# to warm up cache or just fail early
-get_long_langs()
+if __name__ == "__main__":
+    compile_artifact()
+else:
+    # to warm up cache or just fail early
+    get_index()
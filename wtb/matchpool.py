@@ -0,0 +1,190 @@
+"""
+In-memory pool of users available for pairing.
+
+Keeps ids of active (pause=False) users per native language and per
+(native language, search language) pair, so a random candidate is picked
+without mongo round-trips. The pool is kept in sync
+through db user listeners and periodically re-warmed from mongo to catch
+up with changes made by other processes.
+"""
+
+import os
+import random
+import threading
+import typing as T
+
+import telegram.ext
+
+from . import logconfig
+from . import db
+from . import asyncdb
+
+logger = logconfig.logger
+
+
+REFRESH_INTERVAL = float(os.environ.get("WTB_MATCH_POOL_REFRESH_INTERVAL", "600"))
+
+# prefer partners who want to practice requester's native language
+RECIPROCAL_MATCHING = os.environ.get("WTB_RECIPROCAL_MATCHING", "0") == "1"
+
+# random picks before falling back to a linear scan, scan is needed
+# only if most of language speakers are excluded
+RANDOM_PICKS = 8
+
+
+def _is_available(doc: dict) -> bool:
+    # mimics db.get_pair filter
+    return doc.get("pause") is False and bool(doc.get("language"))
+
+
+class _Index:
+    """
+    User ids grouped by key with O(1) random choice and removal
+    """
+
+    def __init__(self):
+        # key -> user ids, list for O(1) random choice
+        self._members: dict[T.Hashable, list[int]] = {}
+        # user id -> (key, position in members list) for O(1) removal
+        self._positions: dict[int, tuple[T.Hashable, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def add(self, user_id: int, key: T.Hashable) -> None:
+        members = self._members.setdefault(key, [])
+        self._positions[user_id] = (key, len(members))
+        members.append(user_id)
+
+    def remove(self, user_id: int) -> None:
+        position = self._positions.pop(user_id, None)
+        if position is None:
+            return
+
+        key, index = position
+        members = self._members[key]
+
+        # move last member into freed slot
+        last = members.pop()
+        if last != user_id:
+            members[index] = last
+            self._positions[last] = (key, index)
+
+    def count(self, key: T.Hashable) -> int:
+        return len(self._members.get(key, ()))
+
+    def pick(self, key: T.Hashable, exclude: T.Container[int]) -> int | None:
+        members = self._members.get(key)
+        if not members:
+            return None
+
+        for _ in range(RANDOM_PICKS):
+            user_id = random.choice(members)
+            if user_id not in exclude:
+                return user_id
+
+        candidates = [user_id for user_id in members if user_id not in exclude]
+        return random.choice(candidates) if candidates else None
+
+
+class MatchPool:
+    def __init__(self):
+        # listeners are called from db thread pool
+        self._lock = threading.Lock()
+        self._by_language = _Index()
+        # by (language, search_language) for reciprocal matching
+        self._by_languages = _Index()
+        # changes which happened while warming up, None if not warming up
+        self._pending: list[dict] | None = None
+        self.ready = False
+
+    def _update(self, doc: dict) -> None:
+        user_id = doc["user_id"]
+        self._by_language.remove(user_id)
+        self._by_languages.remove(user_id)
+
+        if _is_available(doc):
+            self._by_language.add(user_id, doc["language"])
+            if doc.get("search_language"):
+                self._by_languages.add(user_id, (doc["language"], doc["search_language"]))
+
+    def on_user_changed(self, before: dict | None, after: dict) -> None:
+        with self._lock:
+            self._update(after)
+            if self._pending is not None:
+                self._pending.append(after)
+
+    def warm(self) -> None:
+        """
+        Load available users from mongo. Blocking, call it from db thread pool.
+        """
+        with self._lock:
+            self._pending = []
+
+        fresh = MatchPool()
+        for doc in db.get_active_users():
+            fresh._update(doc)
+
+        with self._lock:
+            self._by_language = fresh._by_language
+            self._by_languages = fresh._by_languages
+
+            # replay changes which could be missed by the query above
+            for doc in self._pending:
+                self._update(doc)
+
+            self._pending = None
+            self.ready = True
+
+        logger.info("Match pool warmed up: %s users", len(self._by_language))
+
+    def count(self, language: str) -> int:
+        with self._lock:
+            return self._by_language.count(language)
+
+    def pick(self, language: str, exclude: T.Container[int]) -> int | None:
+        """
+        Return random available user with given native language which is not in *exclude*
+        """
+        with self._lock:
+            return self._by_language.pick(language, exclude)
+
+    def pick_reciprocal(self, language: str, search_language: str, exclude: T.Container[int]) -> int | None:
+        """
+        Same as pick, but the user should also want to practice *search_language*
+        """
+        with self._lock:
+            return self._by_languages.pick((language, search_language), exclude)
+
+
+MATCH_POOL = MatchPool()
+db.add_user_listener(MATCH_POOL.on_user_changed)
+
+
+async def get_pair(skip_users: set[int], language: str, own_language: str | None = None) -> dict | None:
+    """
+    Same as db.get_pair, but served from the pool once it's warmed up.
+
+    In reciprocal matching mode users who know *language* and want to
+    practice *own_language* (requester's native one) are preferred, their
+    pair has "reciprocal" flag set.
+    """
+    if RECIPROCAL_MATCHING and own_language:
+        if MATCH_POOL.ready:
+            user_id = MATCH_POOL.pick_reciprocal(language, own_language, skip_users)
+            pair = {"user_id": user_id} if user_id is not None else None
+        else:
+            pair = await asyncdb.get_reciprocal_pair(list(skip_users), language, own_language)
+
+        if pair is not None:
+            return {**pair, "reciprocal": True}
+
+    if not MATCH_POOL.ready:
+        return await asyncdb.get_pair(list(skip_users), language)
+
+    user_id = MATCH_POOL.pick(language, skip_users)
+    return {"user_id": user_id} if user_id is not None else None
+
+
+async def warm_job(context: telegram.ext.ContextTypes.DEFAULT_TYPE) -> None:
+    await asyncdb.run(MATCH_POOL.warm)
@@ -0,0 +1,95 @@
+"""
+Log of incoming messages.
+
+Only a slim record is stored per message: ids, text length, handler name
+and handling time. Records expire after MESSAGES_TTL_DAYS, the TTL index
+is declared in migrations.INDEXES.
+
+Older history was stored as full telegram payloads, compact() rewrites
+it into the slim form (wtb-compact-messages command).
+"""
+
+import os
+import datetime
+
+import pymongo
+
+from . import logconfig
+from . import db
+
+logger = logconfig.logger
+
+
+MESSAGES_TTL_DAYS = int(os.environ.get("WTB_MESSAGES_TTL_DAYS", "90"))
+COMPACTION_BATCH_SIZE = 1000
+
+# only documents in the old format have these
+_FULL_PAYLOAD_QUERY = {"chat": {"$exists": True}}
+
+
+def make_record(
+        message_id: int,
+        chat_id: int,
+        user_id: int | None,
+        text: str | None,
+        handler: str | None,
+        duration_ms: float | None,
+        date: datetime.datetime,
+) -> dict:
+    return {
+        "message_id": message_id,
+        "chat_id": chat_id,
+        "user_id": user_id,
+        "text_len": len(text) if text else 0,
+        "handler": handler,
+        "duration_ms": duration_ms,
+        "date": date,
+    }
+
+
+def _compact_doc(doc: dict) -> dict:
+    record = make_record(
+        message_id=doc.get("message_id"),
+        chat_id=doc["chat"].get("id"),
+        user_id=(doc.get("from") or {}).get("id"),
+        text=doc.get("text"),
+        handler=None,
+        duration_ms=None,
+        date=doc["date"],
+    )
+    record["_id"] = doc["_id"]
+    return record
+
+
+def compact(batch_size: int = COMPACTION_BATCH_SIZE) -> int:
+    """
+    Rewrite messages stored as full telegram payloads into slim records,
+    return number of rewritten documents. Safe to interrupt and rerun.
+    """
+    collection = db.get_messages_collection()
+    cursor = collection.find(
+        _FULL_PAYLOAD_QUERY,
+        {"message_id": True, "chat.id": True, "from.id": True, "text": True, "date": True},
+        batch_size=batch_size,
+    )
+
+    compacted = 0
+    operations = []
+
+    for doc in cursor:
+        # filter guards against documents rewritten by a concurrent run
+        operations.append(pymongo.ReplaceOne({"_id": doc["_id"], **_FULL_PAYLOAD_QUERY}, _compact_doc(doc)))
+
+        if len(operations) >= batch_size:
+            compacted += collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+            logger.info("Compacted %s messages", compacted)
+
+    if operations:
+        compacted += collection.bulk_write(operations, ordered=False).modified_count
+
+    return compacted
+
+
+def main() -> None:
+    logger.info("Compacted %s messages in total", compact())
@@ -0,0 +1,236 @@
+"""
+Minimal Prometheus-style metrics.
+
+Metrics are registered at import time of the modules which use them and
+exposed in Prometheus text format by a local HTTP server running in a
+background thread. Updating a metric costs a lock and a dict lookup, so
+it's fine to leave it on in production.
+"""
+
+import os
+import time
+import bisect
+import functools
+import threading
+import contextlib
+import http.server
+import typing as T
+
+from . import logconfig
+
+logger = logconfig.logger
+
+
+METRICS_LISTEN = os.environ.get("WTB_METRICS_LISTEN", "127.0.0.1")
+# 0 disables metrics server
+METRICS_PORT = int(os.environ.get("WTB_METRICS_PORT", "9100"))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_REGISTRY: list["_Metric"] = []
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self._lock = threading.Lock()
+        _REGISTRY.append(self)
+
+    def _key(self, labels: dict[str, T.Any]) -> tuple:
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.doc}",
+            f"# TYPE {self.name} {self.kind}",
+            *self._render_samples(),
+        ]
+
+    def _render_samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, doc, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_samples(self) -> list[str]:
+        with self._lock:
+            values = list(self._values.items())
+
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in values]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+            self,
+            name: str,
+            doc: str,
+            labels: tuple[str, ...] = (),
+            buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, doc, labels)
+        self.buckets = buckets
+        # labels -> [counts per bucket (last one is +Inf), sum]
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                item = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+
+            item[0][index] += 1
+            item[1] += value
+
+    def get_count(self) -> int:
+        """
+        Number of observations for all label values
+        """
+        with self._lock:
+            return sum(sum(counts) for counts, _ in self._values.values())
+
+    @contextlib.contextmanager
+    def time(self, **labels) -> T.Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_samples(self) -> list[str]:
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+
+        lines = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                labels = _format_labels(self.labels, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+
+        return lines
+
+
+class Callback(_Metric):
+    """
+    Metric which value is taken from *func* on every scrape. *func* returns
+    a number or, if metric has labels, a dict with label values tuples as keys.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            doc: str,
+            func: T.Callable[[], float | dict[tuple, float]],
+            labels: tuple[str, ...] = (),
+            kind: str = "gauge",
+    ):
+        super().__init__(name, doc, labels)
+        self.func = func
+        self.kind = kind
+
+    def _render_samples(self) -> list[str]:
+        values = self.func()
+        if not self.labels:
+            values = {(): values}
+
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in values.items()]
+
+
+def render() -> str:
+    lines = []
+    for metric in _REGISTRY:
+        try:
+            lines.extend(metric.render())
+        except Exception:
+            logger.exception("Failed to render metric %s", metric.name)
+
+    return "\n".join(lines) + "\n"
+
+
+_HANDLER_TYPE = T.TypeVar("_HANDLER_TYPE", bound=T.Callable)
+
+
+def timed(histogram: Histogram, **labels) -> T.Callable[[_HANDLER_TYPE], _HANDLER_TYPE]:
+    """
+    Observe execution time of decorated sync function
+    """
+    def decorator(wrapped: _HANDLER_TYPE) -> _HANDLER_TYPE:
+        @functools.wraps(wrapped)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return wrapped(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        # don't spam log with scrapes
+        pass
+
+
+_SERVER: http.server.ThreadingHTTPServer | None = None
+
+
+def start_server() -> None:
+    global _SERVER
+
+    if not METRICS_PORT or _SERVER is not None:
+        return
+
+    _SERVER = http.server.ThreadingHTTPServer((METRICS_LISTEN, METRICS_PORT), _MetricsHandler)
+    threading.Thread(target=_SERVER.serve_forever, name="wtb-metrics", daemon=True).start()
+    logger.info("Serving metrics on %s:%s/metrics", METRICS_LISTEN, METRICS_PORT)
+
+
+def stop_server() -> None:
+    global _SERVER
+
+    if _SERVER is not None:
+        _SERVER.shutdown()
+        _SERVER.server_close()
+        _SERVER = None
@@ -0,0 +1,242 @@
+"""
+Indices and schema migrations.
+
+Required indices are declared in INDEXES and created on every start,
+create_indexes is idempotent so this is cheap.
+
+Data changes are shipped as migrations: functions in MIGRATIONS list,
+the position in the list (starting from 1) is the schema version. Current
+version is stored in meta collection. Migrations should be idempotent since
+several processes could start at the same time.
+"""
+
+import pymongo
+import pymongo.collection
+import pymongo.database
+
+from . import logconfig
+from . import db
+from . import events
+from . import messagelog
+from . import notifier
+
+logger = logconfig.logger
+
+
+INDEXES = {
+    "users": [
+        pymongo.IndexModel([("user_id", pymongo.ASCENDING)], name="user_id", unique=True),
+        # get_pair and count_language use the prefix, reciprocal matching (see matchpool module) the whole
+        pymongo.IndexModel(
+            [("pause", pymongo.ASCENDING), ("language", pymongo.ASCENDING), ("search_language", pymongo.ASCENDING)],
+            name="pause_language_search_language",
+        ),
+        pymongo.IndexModel([("created_at", pymongo.ASCENDING)], name="created_at"),
+        # notification recipients lookup, see notifier module
+        pymongo.IndexModel(
+            [
+                ("search_language", pymongo.ASCENDING),
+                ("notify", pymongo.ASCENDING),
+                ("pause", pymongo.ASCENDING),
+                ("user_id", pymongo.ASCENDING),
+            ],
+            name="search_language_notify_pause",
+        ),
+        # inactive users lookup, see sweeper module
+        pymongo.IndexModel(
+            [("pause", pymongo.ASCENDING), ("last_seen", pymongo.ASCENDING)],
+            name="pause_last_seen",
+        ),
+    ],
+    # see ratelimit.MongoBackend, idle buckets are full anyway
+    "rate_limits": [
+        pymongo.IndexModel([("updated", pymongo.ASCENDING)], name="updated", expireAfterSeconds=24 * 60 * 60),
+    ],
+    "messages": [
+        pymongo.IndexModel(
+            [("date", pymongo.ASCENDING)],
+            name="date",
+            expireAfterSeconds=messagelog.MESSAGES_TTL_DAYS * 24 * 60 * 60,
+        ),
+    ],
+    "notifications": [
+        pymongo.IndexModel(
+            [("user_id", pymongo.ASCENDING), ("speaker_id", pymongo.ASCENDING)],
+            name="user_id_speaker_id",
+            unique=True,
+        ),
+        pymongo.IndexModel(
+            [("date", pymongo.ASCENDING)],
+            name="date",
+            expireAfterSeconds=notifier.NOTIFY_HISTORY_DAYS * 24 * 60 * 60,
+        ),
+    ],
+    "events": [
+        pymongo.IndexModel(
+            [("date", pymongo.ASCENDING)],
+            name="date",
+            expireAfterSeconds=events.EVENTS_TTL_DAYS * 24 * 60 * 60,
+        ),
+        pymongo.IndexModel([("type", pymongo.ASCENDING), ("date", pymongo.ASCENDING)], name="type_date"),
+    ],
+}
+
+SCHEMA_ID = "schema"
+
+
+def _dedup_users(mongo_db: pymongo.database.Database) -> None:
+    """
+    Unique user_id index can't be built while there are duplicates which
+    could be created by concurrent upserts. Keep the most recently updated one.
+    """
+    duplicates = mongo_db.users.aggregate([
+        {"$sort": {"last_updated": -1}},
+        {"$group": {
+            "_id": "$user_id",
+            "ids": {"$push": "$_id"},
+            "count": {"$sum": 1},
+        }},
+        {"$match": {"count": {"$gt": 1}}},
+    ], allowDiskUse=True)
+
+    for duplicate in duplicates:
+        logger.warning("Removing %s duplicates of user %s", duplicate["count"] - 1, duplicate["_id"])
+        mongo_db.users.delete_many({"_id": {"$in": duplicate["ids"][1:]}})
+
+
+def _trim_sent_requests(mongo_db: pymongo.database.Database) -> None:
+    """
+    sent_requests became bounded, trim documents which exceed the limit
+    """
+    limit = db.SENT_REQUESTS_LIMIT
+    result = mongo_db.users.update_many(
+        {f"sent_requests.{limit}": {"$exists": True}},
+        [{"$set": {"sent_requests": {"$slice": ["$sent_requests", -limit]}}}],
+    )
+    logger.info("Trimmed sent requests of %s users", result.modified_count)
+
+
+def _drop_index(collection: pymongo.collection.Collection, name: str) -> None:
+    if name in collection.index_information():
+        logger.info("Dropping index %s.%s", collection.name, name)
+        collection.drop_index(name)
+
+
+def _add_last_seen(mongo_db: pymongo.database.Database) -> None:
+    """
+    Inactive users are found by last_seen now, start from the last update
+    """
+    result = mongo_db.users.update_many(
+        {"last_seen": {"$exists": False}},
+        [{"$set": {"last_seen": {"$ifNull": ["$last_updated", "$created_at"]}}}],
+    )
+    logger.info("Set last_seen of %s users", result.modified_count)
+    _drop_index(mongo_db.users, "pause_last_updated")
+
+
+def _drop_pause_language_index(mongo_db: pymongo.database.Database) -> None:
+    """
+    pause_language is a prefix of pause_language_search_language
+    """
+    _drop_index(mongo_db.users, "pause_language")
+
+
+def _drop_search_language_index(mongo_db: pymongo.database.Database) -> None:
+    """
+    search_language is a prefix of search_language_notify_pause
+    """
+    _drop_index(mongo_db.users, "search_language")
+
+
+MIGRATIONS = [
+    _dedup_users,
+    _trim_sent_requests,
+    _add_last_seen,
+    _drop_pause_language_index,
+    _drop_search_language_index,
+]
+
+
+def get_schema_version() -> int:
+    meta = db.get_meta_collection().find_one({"_id": SCHEMA_ID})
+    return meta["version"] if meta else 0
+
+
+def migrate() -> None:
+    """
+    Apply pending migrations and create missing indices
+    """
+    mongo_db = db.get_mongo_db()
+    version = get_schema_version()
+
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        logger.info("Applying migration %s: %s", number, migration.__name__)
+        migration(mongo_db)
+        db.get_meta_collection().update_one(
+            {"_id": SCHEMA_ID},
+            {"$max": {"version": number}},
+            upsert=True,
+        )
+
+    ensure_indexes()
+
+
+def _update_ttl(mongo_db: pymongo.database.Database, collection_name: str, indexes: list) -> None:
+    """
+    create_indexes fails if TTL of an existing index has changed, update it in place
+    """
+    existing = mongo_db[collection_name].index_information()
+
+    for index in indexes:
+        name = index.document["name"]
+        ttl = index.document.get("expireAfterSeconds")
+        if name not in existing or ttl is None:
+            continue
+
+        if existing[name].get("expireAfterSeconds") != ttl:
+            logger.info("Changing TTL of %s.%s to %ss", collection_name, name, ttl)
+            mongo_db.command("collMod", collection_name, index={"name": name, "expireAfterSeconds": ttl})
+
+
+def ensure_indexes() -> None:
+    mongo_db = db.get_mongo_db()
+
+    for collection_name, indexes in INDEXES.items():
+        _update_ttl(mongo_db, collection_name, indexes)
+        mongo_db[collection_name].create_indexes(indexes)
+
+
+def report_indexes() -> dict[str, dict[str, list[str]]]:
+    """
+    Return missing, unused (no operations since mongod start) and unknown
+    (not declared in INDEXES) indices per collection.
+    """
+    mongo_db = db.get_mongo_db()
+    report = {}
+
+    for collection_name, indexes in INDEXES.items():
+        collection = mongo_db[collection_name]
+
+        declared = {i.document["name"] for i in indexes}
+        usage = {
+            i["name"]: i["accesses"]["ops"]
+            for i in collection.aggregate([{"$indexStats": {}}])
+        }
+        existing = set(usage) - {"_id_"}
+
+        report[collection_name] = {
+            "missing": sorted(declared - existing),
+            "unused": sorted(name for name in existing if not usage[name]),
+            "unknown": sorted(existing - declared),
+        }
+
+    return report
+
+
+def main() -> None:
+    migrate()
+
+    for collection_name, report in report_indexes().items():
+        for kind, names in report.items():
+            if names:
+                logger.warning("%s indices of %s: %s", kind.capitalize(), collection_name, ", ".join(names))
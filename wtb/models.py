@@ -1,34 +1,102 @@
 import datetime
-import dataclasses
+
+import bson
+import bson.raw_bson
 
 
-@dataclasses.dataclass
 class User:
     """
     username - telegram username
     user_id - telegram user id
     last_updated - utc datetime obj
     created_at - utc datetime obj
-    sent_requests: [<users._id>]
+    notify - user wants to know when a native speaker of search_language joins
+    sent_requests: [{"user_id": ..., "language": ..., "created_at": ...}], last
+        db.SENT_REQUESTS_LIMIT requests only
+
+    Built from mongo documents: unknown fields are ignored and fields which
+    are missing (e.g. not included into projection) get default values.
+    sent_requests could be given as raw BSON documents, they are decoded
+    on first access.
     """
 
+    # field name -> default value
+    FIELDS = {
+        "_id": None,
+        "user_id": None,
+        "last_updated": None,
+        "created_at": None,
+        "language": None,
+        "search_language": "",
+        "first_name": None,
+        "last_name": None,
+        "username": None,
+        "language_code": None,
+        "pause": False,
+        "notify": False,
+    }
+
+    __slots__ = (*FIELDS, "_sent_requests")
+
     _id: str
     user_id: int
     last_updated: datetime.datetime
     created_at: datetime.datetime
     language: str
-    search_language: str = dataclasses.field(default='')
-    sent_requests: list[dict] = dataclasses.field(default_factory=lambda: [])
+    search_language: str
+    first_name: str | None
+    last_name: str | None
+    username: str | None
+    language_code: str | None
+    pause: bool
+    notify: bool
+
+    def __init__(self, **fields):
+        for name, default in self.FIELDS.items():
+            setattr(self, name, fields.get(name, default))
+
+        self._sent_requests: list[dict | bson.raw_bson.RawBSONDocument] | None = fields.get("sent_requests")
+
+    @property
+    def sent_requests(self) -> list[dict]:
+        requests = self._sent_requests
 
-    first_name: str | None = None
-    last_name: str | None = None
-    username: str | None = None
-    language_code: str | None = None
+        if requests is None:
+            requests = self._sent_requests = []
+        elif requests and isinstance(requests[0], bson.raw_bson.RawBSONDocument):
+            requests = self._sent_requests = [bson.decode(r.raw) for r in requests]
 
-    pause: bool = dataclasses.field(default=False)
+        return requests
+
+    def replace(self, **changes) -> "User":
+        """
+        Return copy of the user with *changes* applied
+        """
+        user = User.__new__(User)
+        for name in self.__slots__:
+            setattr(user, name, getattr(self, name))
+
+        if "sent_requests" in changes:
+            user._sent_requests = changes.pop("sent_requests")
+
+        for name, value in changes.items():
+            if name not in self.FIELDS:
+                raise TypeError(f"Unknown user field: {name}")
+            setattr(user, name, value)
+
+        return user
+
+    def get_contacted_users(self, language: str) -> set[int]:
+        """
+        Ids of users which were already asked to talk in given language
+        """
+        return {r["user_id"] for r in self.sent_requests if r["language"] == language}
 
     def __getitem__(self, key):
         return getattr(self, key)
 
     def get(self, key, default=None):
         return getattr(self, key, default)
+
+    def __repr__(self) -> str:
+        return f"User(user_id={self.user_id!r}, language={self.language!r}, search_language={self.search_language!r})"
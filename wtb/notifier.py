@@ -0,0 +1,202 @@
+"""
+Notifications about new native speakers.
+
+When a user who has just joined becomes available for pairing (or an
+available user changes native language), users who search this language
+and opted in (notify flag) are told about it. Fan-out happens in a
+background task fed through a bounded queue, so handlers are never
+blocked. Recipients are fetched in batches through an
+index, deduplicated and rate limited via notifications collection (each
+user is notified about a speaker once and at most once in
+NOTIFY_INTERVAL), messages are delivered with low priority through the
+outbox.
+"""
+
+import os
+import asyncio
+import datetime
+
+import pymongo
+import pymongo.collection
+import pymongo.errors
+
+from . import logconfig
+from . import db
+from . import asyncdb
+from . import metrics
+from . import outbox
+
+logger = logconfig.logger
+
+
+NOTIFY_QUEUE_SIZE = int(os.environ.get("WTB_NOTIFY_QUEUE_SIZE", "1000"))
+NOTIFY_BATCH_SIZE = int(os.environ.get("WTB_NOTIFY_BATCH_SIZE", "100"))
+# one user gets at most one notification in this number of seconds
+NOTIFY_INTERVAL = float(os.environ.get("WTB_NOTIFY_INTERVAL", str(24 * 60 * 60)))
+# max number of users notified about one speaker
+NOTIFY_MAX_RECIPIENTS = int(os.environ.get("WTB_NOTIFY_MAX_RECIPIENTS", "1000"))
+# notifications history is used for deduplication, should be longer than NOTIFY_INTERVAL
+NOTIFY_HISTORY_DAYS = int(os.environ.get("WTB_NOTIFY_HISTORY_DAYS", "30"))
+# users who become available within this number of seconds after creation are
+# announced, later pause flips (e.g. setting search language again) are not
+NEW_SPEAKER_WINDOW = float(os.environ.get("WTB_NOTIFY_NEW_SPEAKER_WINDOW", str(24 * 60 * 60)))
+# fan-out waits while outbox has more queued messages, so replies to users aren't delayed
+OUTBOX_HIGH_WATER = int(os.environ.get("WTB_NOTIFY_OUTBOX_HIGH_WATER", "500"))
+
+NOTIFICATIONS = metrics.Counter(
+    "wtb_notifications_total",
+    "Notifications about new native speakers by result",
+    labels=("result",),
+)
+
+
+def get_notifications_collection() -> pymongo.collection.Collection:
+    return db.get_mongo_db().notifications
+
+
+def _is_speaker(doc: dict) -> bool:
+    # same as matchpool availability
+    return doc.get("pause") is False and bool(doc.get("language"))
+
+
+def _is_new_speaker(before: dict | None, after: dict) -> bool:
+    """
+    User has just joined and became available or changed native language
+    """
+    if not _is_speaker(after):
+        return False
+
+    if before is not None and before.get("language") and before["language"] != after["language"]:
+        return True
+
+    if before is not None and _is_speaker(before):
+        return False
+
+    created_at = after.get("created_at")
+    return created_at is not None and created_at > datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=NEW_SPEAKER_WINDOW,
+    )
+
+
+def _reserve(user_ids: list[int], speaker_id: int, language: str) -> list[int]:
+    """
+    Record notifications, return ids of users who should be notified
+    """
+    now = datetime.datetime.utcnow()
+    collection = get_notifications_collection()
+
+    recent = {
+        doc["user_id"]
+        for doc in collection.find(
+            {
+                "user_id": {"$in": user_ids},
+                "date": {"$gt": now - datetime.timedelta(seconds=NOTIFY_INTERVAL)},
+            },
+            {"_id": False, "user_id": True},
+        )
+    }
+
+    docs = [
+        {"user_id": user_id, "speaker_id": speaker_id, "language": language, "date": now}
+        for user_id in user_ids
+        if user_id not in recent
+    ]
+    if not docs:
+        return []
+
+    try:
+        collection.insert_many(docs, ordered=False)
+    except pymongo.errors.BulkWriteError as exc:
+        # already notified about this speaker, see unique index
+        duplicates = {docs[error["index"]]["user_id"] for error in exc.details["writeErrors"]}
+        docs = [doc for doc in docs if doc["user_id"] not in duplicates]
+
+    return [doc["user_id"] for doc in docs]
+
+
+class Notifier:
+    def __init__(self):
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=NOTIFY_QUEUE_SIZE)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stop fan-out, queued speakers are dropped
+        """
+        self._loop = None
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def qsize(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def on_user_changed(self, before: dict | None, after: dict) -> None:
+        # called from db thread pool
+        loop = self._loop
+        if loop is None or not _is_new_speaker(before, after):
+            return
+
+        loop.call_soon_threadsafe(self.submit, after["user_id"], after["language"])
+
+    def submit(self, speaker_id: int, language: str) -> None:
+        """
+        Queue notifications about *speaker_id*, dropped if queue is full
+        """
+        try:
+            self._queue.put_nowait((speaker_id, language))
+        except asyncio.QueueFull:
+            NOTIFICATIONS.inc(result="dropped")
+
+    async def _run(self) -> None:
+        while True:
+            speaker_id, language = await self._queue.get()
+            try:
+                await self._fan_out(speaker_id, language)
+            except Exception:
+                logger.exception("Failed to notify about new %s speaker %s", language, speaker_id)
+
+    async def _fan_out(self, speaker_id: int, language: str) -> None:
+        after_user_id = 0
+        notified = 0
+
+        while notified < NOTIFY_MAX_RECIPIENTS:
+            user_ids = await asyncdb.run(db.get_notify_recipients, language, after_user_id, NOTIFY_BATCH_SIZE)
+            if not user_ids:
+                break
+
+            after_user_id = user_ids[-1]
+            candidates = [user_id for user_id in user_ids if user_id != speaker_id][:NOTIFY_MAX_RECIPIENTS - notified]
+            recipients = await asyncdb.run(_reserve, candidates, speaker_id, language)
+            NOTIFICATIONS.inc(len(candidates) - len(recipients), result="skipped")
+
+            while outbox.OUTBOX.qsize() > OUTBOX_HIGH_WATER:
+                await asyncio.sleep(1)
+
+            for user_id in recipients:
+                outbox.OUTBOX.send_nowait(
+                    priority=outbox.PRIORITY_LOW,
+                    chat_id=user_id,
+                    text=(
+                        f"A new native speaker of {language} has just joined. "
+                        "Send a request to chat with someone to practice it. "
+                        "Use /notify to turn these notifications off."
+                    ),
+                )
+
+            NOTIFICATIONS.inc(len(recipients), result="queued")
+            notified += len(recipients)
+
+            if len(user_ids) < NOTIFY_BATCH_SIZE:
+                break
+
+
+NOTIFIER = Notifier()
+db.add_user_listener(NOTIFIER.on_user_changed)
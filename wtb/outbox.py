@@ -0,0 +1,268 @@
+"""
+Outbound message queue which respects telegram flood limits.
+
+Messages (and other bot calls like chat actions, they count towards the
+same limits) are sent by a few background workers in priority order, with
+global and per-chat rate shaping. Replies to users go with high priority. RetryAfter pauses all sending for the
+requested time, network errors are retried with exponential back-off and
+jitter. Callers either await delivery (and get telegram errors like
+Forbidden raised) or fire and forget.
+"""
+
+import os
+import math
+import random
+import asyncio
+import itertools
+import collections
+
+import telegram
+import telegram.error
+
+from . import logconfig
+from . import metrics
+
+logger = logconfig.logger
+
+
+# telegram allows ~30 messages per second overall and ~1 per second per chat,
+# in multi-worker mode the overall limit is split between WTB_WORKER_COUNT workers
+WORKER_COUNT = max(1, int(os.environ.get("WTB_WORKER_COUNT", "1")))
+GLOBAL_RATE = float(os.environ.get("WTB_OUTBOX_GLOBAL_RATE", "25")) / WORKER_COUNT
+CHAT_INTERVAL = float(os.environ.get("WTB_OUTBOX_CHAT_INTERVAL", "1.0"))
+WORKERS = int(os.environ.get("WTB_OUTBOX_WORKERS", "4"))
+MAX_ATTEMPTS = int(os.environ.get("WTB_OUTBOX_MAX_ATTEMPTS", "5"))
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 10
+PRIORITY_LOW = 20
+
+# number of recent delivery latencies to compute percentiles from
+LATENCY_WINDOW = 1000
+
+DELIVERY_LATENCY = metrics.Histogram(
+    "wtb_outbox_delivery_seconds",
+    "Time from queueing a message to its delivery",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
+SEND_LATENCY = metrics.Histogram(
+    "wtb_outbox_send_seconds",
+    "Duration of calls to telegram",
+)
+
+
+class _Job:
+    __slots__ = ("priority", "seq", "method", "kwargs", "future", "created_at", "attempts")
+
+    def __init__(
+            self,
+            priority: int,
+            seq: int,
+            method: str,
+            kwargs: dict,
+            future: asyncio.Future,
+            created_at: float,
+    ):
+        self.priority = priority
+        self.seq = seq
+        self.method = method
+        self.kwargs = kwargs
+        self.future = future
+        self.created_at = created_at
+        self.attempts = 0
+
+    def __lt__(self, other: "_Job") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+def _percentile(values: list[float], percent: float) -> float | None:
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[min(len(values) - 1, math.ceil(len(values) * percent / 100) - 1)]
+
+
+def _log_failure(future: asyncio.Future) -> None:
+    if not future.cancelled() and future.exception():
+        logger.error("Failed to deliver message", exc_info=future.exception())
+
+
+class Outbox:
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+        self._bot: telegram.Bot | None = None
+        self._queue: asyncio.PriorityQueue | None = None
+        self._workers: list[asyncio.Task] = []
+        self._seq = itertools.count()
+        # monotonic time when the next message could be sent
+        self._global_next = 0.0
+        self._chat_next: dict[int | str, float] = {}
+        self._latencies: collections.deque[float] = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def start(self, bot: telegram.Bot) -> None:
+        self._bot = bot
+        self._queue = asyncio.PriorityQueue()
+        self._workers = [asyncio.create_task(self._work()) for _ in range(WORKERS)]
+
+    async def stop(self) -> None:
+        """
+        Stop workers, messages which are still queued are dropped
+        """
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+        if self._queue is not None and self._queue.qsize():
+            logger.warning("Outbox stopped with %s undelivered messages", self._queue.qsize())
+
+    def qsize(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _put(self, priority: int, kwargs: dict, method: str = "send_message") -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.put_nowait(_Job(priority, next(self._seq), method, kwargs, future, loop.time()))
+        return future
+
+    def send_nowait(self, priority: int = PRIORITY_NORMAL, **kwargs) -> None:
+        """
+        Queue bot.send_message(**kwargs) and forget about it, failures are logged
+        """
+        self._put(priority, kwargs).add_done_callback(_log_failure)
+
+    async def send(self, priority: int = PRIORITY_NORMAL, **kwargs) -> telegram.Message:
+        """
+        Queue bot.send_message(**kwargs) and wait for delivery, delivery errors are raised
+        """
+        return await self._put(priority, kwargs)
+
+    async def reply(self, message: telegram.Message, text: str, **kwargs) -> telegram.Message:
+        """
+        Same as message.reply_markdown, but queued with high priority
+        """
+        return await self.send(
+            PRIORITY_HIGH,
+            chat_id=message.chat_id,
+            text=text,
+            parse_mode=telegram.constants.ParseMode.MARKDOWN,
+            **kwargs,
+        )
+
+    async def send_chat_action(self, priority: int = PRIORITY_NORMAL, **kwargs) -> bool:
+        """
+        Queue bot.send_chat_action(**kwargs) and wait for it, errors are raised
+        """
+        return await self._put(priority, kwargs, method="send_chat_action")
+
+    def get_stats(self) -> dict:
+        latencies = list(self._latencies)
+        return {
+            "queued": self.qsize(),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "latency_p50": _percentile(latencies, 50),
+            "latency_p99": _percentile(latencies, 99),
+        }
+
+    def _retry_later(self, job: _Job, delay: float) -> None:
+        self.retried += 1
+        asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, job)
+
+    async def _wait_for_slot(self) -> None:
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+
+        slot = max(now, self._global_next)
+        self._global_next = slot + 1 / GLOBAL_RATE
+
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def _reserve_chat(self, chat_id: int | str) -> float:
+        """
+        Return delay before the chat could receive a message or reserve the chat
+        """
+        now = asyncio.get_running_loop().time()
+
+        ready_at = self._chat_next.get(chat_id, 0.0)
+        if ready_at > now:
+            return ready_at - now
+
+        if len(self._chat_next) > 10000:
+            self._chat_next = {k: v for k, v in self._chat_next.items() if v > now}
+
+        self._chat_next[chat_id] = now + CHAT_INTERVAL
+        return 0.0
+
+    async def _work(self) -> None:
+        loop = asyncio.get_running_loop()
+
+        while True:
+            job = await self._queue.get()
+            if job.future.done():  # cancelled by caller
+                continue
+
+            # don't block the worker on a single busy chat
+            delay = self._reserve_chat(job.kwargs["chat_id"])
+            if delay:
+                loop.call_later(delay, self._queue.put_nowait, job)
+                continue
+
+            await self._wait_for_slot()
+            # count chat interval from the actual sending time
+            self._chat_next[job.kwargs["chat_id"]] = loop.time() + CHAT_INTERVAL
+
+            job.attempts += 1
+            try:
+                with SEND_LATENCY.time():
+                    result = await getattr(self._bot, job.method)(**job.kwargs)
+            except telegram.error.RetryAfter as exc:
+                logger.warning("Flood limit exceeded, pausing sending for %ss", exc.retry_after)
+                self._global_next = max(self._global_next, loop.time() + exc.retry_after)
+                self._retry_later(job, exc.retry_after)
+                continue
+            except telegram.error.BadRequest as exc:  # BadRequest is a NetworkError, don't retry it
+                self._fail(job, exc)
+                continue
+            except telegram.error.NetworkError as exc:
+                if job.attempts >= MAX_ATTEMPTS:
+                    self._fail(job, exc)
+                    continue
+
+                backoff = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** job.attempts)
+                self._retry_later(job, backoff * random.uniform(0.5, 1.5))
+                continue
+            except Exception as exc:
+                self._fail(job, exc)
+                continue
+
+            self.sent += 1
+            latency = loop.time() - job.created_at
+            self._latencies.append(latency)
+            DELIVERY_LATENCY.observe(latency)
+            if not job.future.done():
+                job.future.set_result(result)
+
+    def _fail(self, job: _Job, exc: Exception) -> None:
+        self.failed += 1
+        if not job.future.done():
+            job.future.set_exception(exc)
+
+
+OUTBOX = Outbox()
+
+metrics.Callback(
+    "wtb_outbox_messages_total",
+    "Outbound messages by delivery result",
+    lambda: {("sent",): OUTBOX.sent, ("failed",): OUTBOX.failed, ("retried",): OUTBOX.retried},
+    labels=("result",),
+    kind="counter",
+)
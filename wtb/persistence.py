@@ -0,0 +1,156 @@
+"""
+Conversation states persistence in mongo.
+
+Only conversation states are stored, the bot doesn't use user, chat or
+bot data. This allows to restart the bot or run several workers without
+losing users in the middle of a conversation.
+
+State changes are coalesced: application hands them over once in
+UPDATE_INTERVAL seconds, they are collected into a dirty set (only the
+latest state of a conversation is kept) and written with a single
+bulk_write. The dirty set is flushed earlier if it grows over MAX_DIRTY.
+"""
+
+import os
+import asyncio
+
+import pymongo
+import telegram.ext
+
+from . import logconfig
+from . import db
+from . import asyncdb
+
+logger = logconfig.logger
+
+
+# how often application hands changed states over to the persistence
+UPDATE_INTERVAL = float(os.environ.get("WTB_PERSISTENCE_INTERVAL", "10"))
+MAX_DIRTY = int(os.environ.get("WTB_PERSISTENCE_MAX_DIRTY", "1000"))
+
+
+def get_conversations_collection():
+    return db.get_mongo_db().conversations
+
+
+def _get_doc_id(name: str, key: tuple) -> str:
+    return ":".join([name, *map(str, key)])
+
+
+def _load_conversations(name: str) -> dict[tuple, object]:
+    return {
+        tuple(doc["key"]): doc["state"]
+        for doc in get_conversations_collection().find({"name": name})
+    }
+
+
+def _save_conversations(states: dict[tuple[str, tuple], object | None]) -> None:
+    operations = []
+
+    for (name, key), new_state in states.items():
+        doc_id = _get_doc_id(name, key)
+
+        if new_state is None:  # conversation has ended
+            operations.append(pymongo.DeleteOne({"_id": doc_id}))
+        else:
+            operations.append(pymongo.UpdateOne(
+                {"_id": doc_id},
+                {"$set": {"name": name, "key": list(key), "state": new_state}},
+                upsert=True,
+            ))
+
+    get_conversations_collection().bulk_write(operations, ordered=False)
+
+
+class MongoPersistence(telegram.ext.BasePersistence):
+    def __init__(self, update_interval: float = UPDATE_INTERVAL, max_dirty: int = MAX_DIRTY):
+        super().__init__(
+            store_data=telegram.ext.PersistenceInput(
+                bot_data=False,
+                chat_data=False,
+                user_data=False,
+                callback_data=False,
+            ),
+            update_interval=update_interval,
+        )
+
+        self.max_dirty = max_dirty
+        # (conversation name, key) -> latest state, None if conversation has ended
+        self._dirty: dict[tuple[str, tuple], object | None] = {}
+        self._flush_task: asyncio.Task | None = None
+        self._flush_lock = asyncio.Lock()
+
+    async def get_conversations(self, name: str) -> dict[tuple, object]:
+        return await asyncdb.run(_load_conversations, name)
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object | None) -> None:
+        self._dirty[(name, key)] = new_state
+
+        if len(self._dirty) >= self.max_dirty:
+            await self._flush()
+        elif self._flush_task is None:
+            # application updates all changed conversations at once, the task
+            # starts after all of them are marked, so they are written together
+            self._flush_task = asyncio.create_task(self._flush())
+
+    async def _flush(self) -> None:
+        async with self._flush_lock:
+            self._flush_task = None
+            if not self._dirty:
+                return
+
+            states, self._dirty = self._dirty, {}
+
+            try:
+                await asyncdb.run(_save_conversations, states)
+            except Exception:
+                logger.exception("Failed to save %s conversation states", len(states))
+                # retry on the next flush unless there are newer states already
+                for conversation, state in states.items():
+                    self._dirty.setdefault(conversation, state)
+
+    async def flush(self) -> None:
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._flush()
+
+    # the rest of data isn't stored
+
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data: object) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
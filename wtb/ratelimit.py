@@ -0,0 +1,174 @@
+"""
+Token bucket rate limiting of handlers per user and command.
+
+Buckets are kept in memory of the process by default. Set
+WTB_RATE_LIMIT_BACKEND=mongo to share them between several bot instances.
+"""
+
+import os
+import math
+import time
+import functools
+import threading
+import collections
+import typing as T
+
+import pymongo
+import telegram
+import telegram.ext
+
+from . import logconfig
+from . import db
+from . import asyncdb
+from . import outbox
+
+logger = logconfig.logger
+
+
+BACKEND_MEMORY = "memory"
+BACKEND_MONGO = "mongo"
+RATE_LIMIT_BACKEND = os.environ.get("WTB_RATE_LIMIT_BACKEND", BACKEND_MEMORY)
+
+
+class MemoryBackend:
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        # key -> (tokens, last update time), least recently used first
+        self._buckets: collections.OrderedDict[str, tuple[float, float]] = collections.OrderedDict()
+
+    async def acquire(self, key: str, capacity: float, rate: float) -> float:
+        """
+        Take a token from the bucket, return 0 on success or number of
+        seconds to wait for the next token
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) / rate
+
+            self._buckets[key] = (tokens, now)
+            # buckets of inactive users are full anyway, so dropping them is harmless
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+
+        return wait
+
+
+def get_rate_limits_collection():
+    return db.get_mongo_db().rate_limits
+
+
+class MongoBackend:
+    """
+    Buckets are updated atomically by a pipeline update, so they could be
+    shared by several processes. Server time is used to avoid clock skew.
+    """
+
+    async def acquire(self, key: str, capacity: float, rate: float) -> float:
+        return await asyncdb.run(self._acquire, key, capacity, rate)
+
+    def _acquire(self, key: str, capacity: float, rate: float) -> float:
+        bucket = get_rate_limits_collection().find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {
+                    "tokens": {"$min": [capacity, {"$add": [
+                        {"$ifNull": ["$tokens", capacity]},
+                        {"$multiply": [
+                            rate / 1000,  # date difference is in ms
+                            {"$subtract": ["$$NOW", {"$ifNull": ["$updated", "$$NOW"]}]},
+                        ]},
+                    ]}]},
+                    "updated": "$$NOW",
+                }},
+                {"$set": {
+                    "allowed": {"$gte": ["$tokens", 1]},
+                    "tokens": {"$cond": [
+                        {"$gte": ["$tokens", 1]},
+                        {"$subtract": ["$tokens", 1]},
+                        "$tokens",
+                    ]},
+                }},
+            ],
+            upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER,
+        )
+
+        if bucket["allowed"]:
+            return 0.0
+
+        return (1 - bucket["tokens"]) / rate
+
+
+_BACKEND: MemoryBackend | MongoBackend | None = None
+
+
+def get_backend() -> MemoryBackend | MongoBackend:
+    global _BACKEND
+
+    if _BACKEND is None:
+        if RATE_LIMIT_BACKEND == BACKEND_MEMORY:
+            _BACKEND = MemoryBackend()
+        elif RATE_LIMIT_BACKEND == BACKEND_MONGO:
+            _BACKEND = MongoBackend()
+        else:
+            raise ValueError(f"Unknown rate limit backend: {RATE_LIMIT_BACKEND}")
+
+    return _BACKEND
+
+
+_HANDLER_RETURN_VAR = T.TypeVar("_HANDLER_RETURN_VAR")
+_HANDLER_TYPE = T.Callable[
+    [
+        telegram.Update,
+        telegram.ext.ContextTypes.DEFAULT_TYPE,
+    ],
+    T.Awaitable[_HANDLER_RETURN_VAR],
+]
+
+
+def limit(command: str, burst: int, period: float) -> T.Callable[[_HANDLER_TYPE], _HANDLER_TYPE]:
+    """
+    Allow a user to call the handler *burst* times in a row and then once
+    per *period* seconds. Over the limit user gets a cooldown message and
+    the handler returns None.
+    """
+    rate = 1 / period
+
+    def decorator(wrapped: _HANDLER_TYPE) -> _HANDLER_TYPE:
+        @functools.wraps(wrapped)
+        async def wrapper(
+                update: telegram.Update,
+                context: telegram.ext.ContextTypes.DEFAULT_TYPE,
+        ) -> _HANDLER_RETURN_VAR | None:
+            key = f"{update.effective_user.id}:{command}"
+
+            try:
+                wait = await get_backend().acquire(key, burst, rate)
+            except Exception:
+                # it's better to let the request through than to lock users out
+                logger.exception("Failed to check rate limit of %s", key)
+                wait = 0
+
+            if wait:
+                logger.info("Rate limited %s for %.1fs", key, wait)
+                await outbox.OUTBOX.reply(
+                    update.message,
+                    "You are doing this too often. Please, try again in "
+                    f"{math.ceil(wait)} seconds."
+                )
+                return None
+
+            return await wrapped(update, context)
+
+        return wrapper
+
+    return decorator
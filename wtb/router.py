@@ -0,0 +1,105 @@
+"""
+Webhook router for multi-worker mode.
+
+Receives updates from telegram and forwards each of them to one of the
+workers (bots running in webhook mode) by user id, so all updates of a
+user are processed by the same worker in order.
+"""
+
+import os
+import json
+import asyncio
+
+import tornado.web
+import tornado.httpclient
+
+from . import logconfig
+from . import webhookconfig
+
+logger = logconfig.logger
+
+
+ROUTER_LISTEN = os.environ.get("WTB_ROUTER_LISTEN", "0.0.0.0")
+ROUTER_PORT = int(os.environ.get("WTB_ROUTER_PORT", "8443"))
+# number of workers, their webhook URLs are WORKER_URL_TEMPLATE with worker
+# number from 1 to WORKER_COUNT (names of docker compose replicas)
+WORKER_COUNT = int(os.environ.get("WTB_WORKER_COUNT", "0"))
+WORKER_URL_TEMPLATE = os.environ.get(
+    "WTB_WORKER_URL_TEMPLATE",
+    f"http://wtb-wtb-worker-{{}}:8443/{webhookconfig.WEBHOOK_PATH}",
+)
+# full webhook URLs of workers, order matters: it defines partitioning;
+# explicit list overrides WORKER_COUNT
+WORKER_URLS = (
+    [url.strip() for url in os.environ.get("WTB_WORKER_URLS", "").split(",") if url.strip()]
+    or [WORKER_URL_TEMPLATE.format(number) for number in range(1, WORKER_COUNT + 1)]
+)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def get_partition_key(update: dict) -> int:
+    """
+    Return id of the user (or chat) which sent the update, 0 if there is none
+    """
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+
+        user = value.get("from") or value.get("user")
+        if user:
+            return user["id"]
+
+        chat = value.get("chat")
+        if chat:
+            return chat["id"]
+
+    return 0
+
+
+class UpdateHandler(tornado.web.RequestHandler):
+    async def post(self) -> None:
+        secret = self.request.headers.get(SECRET_HEADER)
+        if webhookconfig.WEBHOOK_SECRET and secret != webhookconfig.WEBHOOK_SECRET:
+            raise tornado.web.HTTPError(403)
+
+        try:
+            update = json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+
+        worker_url = WORKER_URLS[get_partition_key(update) % len(WORKER_URLS)]
+
+        headers = {"Content-Type": "application/json"}
+        if secret:
+            headers[SECRET_HEADER] = secret
+
+        response = await tornado.httpclient.AsyncHTTPClient().fetch(
+            worker_url,
+            method="POST",
+            body=self.request.body,
+            headers=headers,
+            raise_error=False,
+        )
+
+        # non 200 response makes telegram retry the update later
+        if response.code != 200:
+            logger.error("Worker %s failed to accept update: %s", worker_url, response.code)
+            raise tornado.web.HTTPError(502)
+
+
+async def serve() -> None:
+    if not WORKER_URLS:
+        raise ValueError("WTB_WORKER_COUNT or WTB_WORKER_URLS must be set")
+
+    app = tornado.web.Application([
+        (rf"/{webhookconfig.WEBHOOK_PATH}", UpdateHandler),
+    ])
+    app.listen(ROUTER_PORT, ROUTER_LISTEN)
+
+    logger.info("Routing updates to %s workers", len(WORKER_URLS))
+    await asyncio.Event().wait()
+
+
+def main() -> None:
+    asyncio.run(serve())
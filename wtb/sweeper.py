@@ -0,0 +1,139 @@
+"""
+Background sweeper which keeps the pool of pairing candidates clean.
+
+Active users are probed in batches with a chat action (through the outbox
+with low priority, so probes don't delay replies), users who blocked
+the bot or deleted their account are paused, so find_pair doesn't waste
+attempts on them. The probe is visible: the user sees the bot "typing..."
+for a few seconds. So every user is probed at most once per
+PROBE_INTERVAL_DAYS and users who wrote to the bot within this period are
+skipped as they are reachable anyway.
+
+Optionally users who haven't written to the bot for INACTIVE_DAYS are
+paused as well. Only one worker sweeps at a time, progress is stored in
+meta collection, so sweeping continues after restarts.
+"""
+
+import os
+import asyncio
+import datetime
+
+import telegram
+import telegram.constants
+import telegram.error
+import telegram.ext
+
+from . import logconfig
+from . import db
+from . import asyncdb
+from . import outbox
+from . import coordination
+from . import events
+from . import metrics
+
+logger = logconfig.logger
+
+
+SWEEP_INTERVAL = float(os.environ.get("WTB_SWEEP_INTERVAL", "60"))
+SWEEP_BATCH_SIZE = int(os.environ.get("WTB_SWEEP_BATCH_SIZE", "100"))
+# probes per second, chat actions count against the same flood limits as
+# messages, so keep it well below telegram limit minus outbox rate
+SWEEP_RATE = float(os.environ.get("WTB_SWEEP_RATE", "2"))
+# a pass over all active users starts at most once in this number of days, 0 disables probing
+PROBE_INTERVAL_DAYS = float(os.environ.get("WTB_PROBE_INTERVAL_DAYS", "7"))
+# 0 disables, activity is tracked by last_seen which is refreshed by messages from user
+INACTIVE_DAYS = float(os.environ.get("WTB_INACTIVE_DAYS", "0"))
+
+PROGRESS_ID = "sweeper"
+
+PAUSED = metrics.Counter(
+    "wtb_sweeper_paused_total",
+    "Users paused by sweeper",
+    labels=("reason",),
+)
+
+
+def _get_progress() -> dict:
+    """
+    last_user_id - last probed user of current pass, 0 if the pass is over
+    pass_started_at - utc datetime obj
+    """
+    return db.get_meta_collection().find_one({"_id": PROGRESS_ID}) or {}
+
+
+def _set_progress(**progress) -> None:
+    db.get_meta_collection().update_one(
+        {"_id": PROGRESS_ID},
+        {"$set": progress},
+        upsert=True,
+    )
+
+
+def _is_unreachable(exc: telegram.error.TelegramError) -> bool:
+    if isinstance(exc, telegram.error.Forbidden):  # blocked or deactivated
+        return True
+
+    return isinstance(exc, telegram.error.BadRequest) and "chat not found" in exc.message.lower()
+
+
+async def probe_users() -> None:
+    """
+    Probe next batch of active users, pause unreachable ones
+    """
+    now = datetime.datetime.utcnow()
+    interval = datetime.timedelta(days=PROBE_INTERVAL_DAYS)
+
+    progress = await asyncdb.run(_get_progress)
+    last_user_id = progress.get("last_user_id", 0)
+
+    if not last_user_id:
+        pass_started_at = progress.get("pass_started_at")
+        if pass_started_at is not None and pass_started_at > now - interval:
+            return
+
+        await asyncdb.run(_set_progress, pass_started_at=now)
+
+    user_ids = await asyncdb.get_active_user_ids(last_user_id, SWEEP_BATCH_SIZE, seen_before=now - interval)
+
+    for user_id in user_ids:
+        try:
+            await outbox.OUTBOX.send_chat_action(
+                outbox.PRIORITY_LOW,
+                chat_id=user_id,
+                action=telegram.constants.ChatAction.TYPING,
+            )
+        except telegram.error.TelegramError as exc:
+            if _is_unreachable(exc):
+                PAUSED.inc(reason="unreachable")
+                await events.emit(events.USER_BLOCKED, user_id, source="sweeper")
+                await asyncdb.update_wtb_user({"user_id": user_id}, {"pause": True})
+            else:
+                logger.warning("Failed to probe user %s: %s", user_id, exc)
+
+        last_user_id = user_id
+        await asyncio.sleep(1 / SWEEP_RATE)
+    else:
+        if len(user_ids) < SWEEP_BATCH_SIZE:  # reached the end, next pass starts after PROBE_INTERVAL_DAYS
+            last_user_id = 0
+
+    await asyncdb.run(_set_progress, last_user_id=last_user_id)
+
+
+async def pause_inactive_users() -> None:
+    users = await asyncdb.get_inactive_users(INACTIVE_DAYS, SWEEP_BATCH_SIZE)
+
+    for user in users:
+        PAUSED.inc(reason="inactive")
+        await asyncdb.update_wtb_user(user, {"pause": True})
+
+    if users:
+        logger.info("Paused %s inactive users", len(users))
+
+
+@coordination.singleton(PROGRESS_ID, SWEEP_INTERVAL * 2)
+async def sweep_job(context: telegram.ext.ContextTypes.DEFAULT_TYPE) -> None:
+    if INACTIVE_DAYS:
+        await pause_inactive_users()
+
+    if PROBE_INTERVAL_DAYS:
+        await probe_users()
@@ -0,0 +1,182 @@
+"""
+In-memory usage statistics for /stats command.
+
+Counters are updated incrementally on every db.update_wtb_user call and
+periodically reconciled with mongo to fix any drift (users changed by
+other processes, writes lost during reconciliation, etc).
+
+With several workers only the owner of the lease reconciles stats and
+publishes them to meta collection, the rest load published stats.
+"""
+
+import os
+import datetime
+import threading
+import collections
+
+import telegram.ext
+
+from . import logconfig
+from . import db
+from . import asyncdb
+from . import coordination
+
+logger = logconfig.logger
+
+
+RECENT_DAYS = 30
+TOP_LIMIT = 5
+RECONCILE_INTERVAL = float(os.environ.get("WTB_STATS_RECONCILE_INTERVAL", "600"))
+
+PUBLISHED_ID = "usage_stats"
+
+
+def _day(date: datetime.datetime) -> str:
+    return date.strftime("%Y-%m-%d")
+
+
+def _contribution(doc: dict) -> tuple[bool, str | None, str | None]:
+    return doc.get("pause") is not True, doc.get("language"), doc.get("search_language")
+
+
+class UsageStats:
+    def __init__(self):
+        # listeners are called from db thread pool
+        self._lock = threading.Lock()
+        self._snapshot: dict | None = None
+        self._reset()
+
+    def _reset(self) -> None:
+        self.total = 0
+        self.active = 0
+        self.known: collections.Counter[str] = collections.Counter()
+        self.wanted: collections.Counter[str] = collections.Counter()
+        self.pairs: collections.Counter[tuple[str, str]] = collections.Counter()
+        # number of users created per day ("YYYY-MM-DD") within last RECENT_DAYS
+        self.recent: collections.Counter[str] = collections.Counter()
+
+    def _apply(self, doc: dict, sign: int, count: int = 1) -> None:
+        active, language, search_language = _contribution(doc)
+        count *= sign
+
+        if active:
+            self.active += count
+        if language is not None:
+            self.known[language] += count
+        if search_language is not None:
+            self.wanted[search_language] += count
+        if language is not None and search_language is not None:
+            self.pairs[tuple(sorted((language, search_language)))] += count
+
+    def on_user_changed(self, before: dict | None, after: dict) -> None:
+        if before is not None and _contribution(before) == _contribution(after):
+            return
+
+        with self._lock:
+            if before is None:
+                self.total += 1
+                self.recent[_day(after["created_at"])] += 1
+            else:
+                self._apply(before, -1)
+
+            self._apply(after, 1)
+            self._snapshot = None
+
+    def reconcile(self) -> None:
+        """
+        Rebuild counters from mongo. Blocking, call it from db thread pool.
+        """
+        fresh = UsageStats()
+
+        for group in db.get_language_groups():
+            fresh.total += group["count"]
+            fresh._apply(group["_id"], 1, group["count"])
+
+        since = datetime.datetime.utcnow() - datetime.timedelta(days=RECENT_DAYS)
+        for group in db.get_daily_user_counts(since.replace(hour=0, minute=0, second=0, microsecond=0)):
+            fresh.recent[group["_id"]] = group["count"]
+
+        self._replace(fresh)
+
+        logger.info("Usage stats reconciled: %s users", self.total)
+
+    def _replace(self, fresh: "UsageStats") -> None:
+        with self._lock:
+            self.total = fresh.total
+            self.active = fresh.active
+            self.known = +fresh.known
+            self.wanted = +fresh.wanted
+            self.pairs = +fresh.pairs
+            self.recent = fresh.recent
+            self._snapshot = None
+
+    def publish(self) -> None:
+        """
+        Store counters for other workers. Blocking, call it from db thread pool.
+        """
+        with self._lock:
+            doc = {
+                "total": self.total,
+                "active": self.active,
+                "known": list(self.known.items()),
+                "wanted": list(self.wanted.items()),
+                "pairs": [[*pair, count] for pair, count in self.pairs.items()],
+                "recent": list(self.recent.items()),
+                "published_at": datetime.datetime.utcnow(),
+            }
+
+        db.get_meta_collection().replace_one({"_id": PUBLISHED_ID}, doc, upsert=True)
+
+    def load_published(self) -> None:
+        """
+        Replace counters with ones published by another worker. Blocking,
+        call it from db thread pool.
+        """
+        doc = db.get_meta_collection().find_one({"_id": PUBLISHED_ID})
+        if doc is None:
+            return
+
+        fresh = UsageStats()
+        fresh.total = doc["total"]
+        fresh.active = doc["active"]
+        fresh.known.update(dict(doc["known"]))
+        fresh.wanted.update(dict(doc["wanted"]))
+        fresh.pairs.update({(a, b): count for a, b, count in doc["pairs"]})
+        fresh.recent.update(dict(doc["recent"]))
+
+        self._replace(fresh)
+
+    def snapshot(self) -> dict:
+        """
+        Return current stats. Top lists are recomputed only after changes.
+        """
+        threshold = _day(datetime.datetime.utcnow() - datetime.timedelta(days=RECENT_DAYS))
+
+        with self._lock:
+            for day in [day for day in self.recent if day < threshold]:
+                del self.recent[day]
+                self._snapshot = None
+
+            if self._snapshot is None:
+                self._snapshot = {
+                    "total": self.total,
+                    "active": self.active,
+                    "recent": sum(self.recent.values()),
+                    "top_wanted": self.wanted.most_common(TOP_LIMIT),
+                    "top_known": self.known.most_common(TOP_LIMIT),
+                    "top_pairs": self.pairs.most_common(TOP_LIMIT),
+                }
+
+            return self._snapshot
+
+
+USAGE_STATS = UsageStats()
+db.add_user_listener(USAGE_STATS.on_user_changed)
+
+
+async def reconcile_job(context: telegram.ext.ContextTypes.DEFAULT_TYPE) -> None:
+    if await asyncdb.run(coordination.acquire_lease, PUBLISHED_ID, RECONCILE_INTERVAL * 2):
+        await asyncdb.run(USAGE_STATS.reconcile)
+        await asyncdb.run(USAGE_STATS.publish)
+    else:
+        await asyncdb.run(USAGE_STATS.load_published)
@@ -0,0 +1,10 @@
+"""
+Webhook settings shared by bot workers (see botutils) and the router, so
+the router doesn't need the rest of bot settings like telegram token.
+"""
+
+import os
+
+
+WEBHOOK_PATH = os.environ.get("WTB_WEBHOOK_PATH", "")
+WEBHOOK_SECRET = os.environ.get("WTB_WEBHOOK_SECRET")